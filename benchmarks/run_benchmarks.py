@@ -0,0 +1,418 @@
+### Benchmark suite for the Python hot paths of pairing (inst/python/pairing) and TCRdist (inst/python/TCRdist).
+###
+### Each case (target function x synthetic data set x chunk_size x backend ...) runs in a fresh process, so peak RSS is
+### measured per case. Results (wall time, peak RSS, throughput) are written to a JSON file, and every output is reduced
+### to a digest that is checked against the reference file (benchmarks/reference.json) and across the cases of the same
+### data set (chunk sizes, backends and kernels must not change the results). Any mismatch or error exits with status 1.
+###
+### python benchmarks/run_benchmarks.py                                     # quick suite, numpy
+### python benchmarks/run_benchmarks.py --suite full --backends numpy,cupy --out results.json
+### python benchmarks/run_benchmarks.py --targets TCRdist_batch --chunk-sizes 500,1000,2000
+### python benchmarks/run_benchmarks.py --update-reference                  # after an intended change of the outputs
+
+import os
+import sys
+import io
+import json
+import time
+import hashlib
+import argparse
+import platform
+import itertools
+import importlib
+import traceback
+import contextlib
+import subprocess
+import multiprocessing
+from datetime import datetime
+import numpy as np
+
+try:
+    import resource
+except ImportError: # not available on Windows, peak RSS is not recorded there
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+import synthetic
+
+REPO_DIR = synthetic.REPO_DIR
+PYTHON_DIR = os.path.join(REPO_DIR, "inst", "python")
+REFERENCE_FILE = os.path.join(BENCH_DIR, "reference.json")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+### Parameters that only change how the work is done (not its result): cases that differ only in these share a reference
+SWEEP_KEYS = ["backend", "chunk_size", "kernel", "n_workers"]
+
+PLATE_QUICK = {"n_clones": [100000], "n_wells": [96, 384], "cells_per_well": [500], "clone_size": ["powerlaw"], "dropout": [0.1],
+               "chunk_size": [250, 1000]}
+PLATE_FULL = {"n_clones": [100000, 300000], "n_wells": [96, 384, 768], "cells_per_well": [500, 2000],
+              "clone_size": ["powerlaw", "lognormal"], "dropout": [0.1, 0.3], "chunk_size": [250, 500, 1000]}
+
+### Parameter grids per suite and target; every combination is one case (backends are added from the command line)
+SUITES = {
+    "quick": {
+        "madhyper_process": PLATE_QUICK,
+        "correlation_process": PLATE_QUICK,
+        "fused_process": PLATE_QUICK,
+        "top3_indices": {"n_rows": [500], "n_cols": [5000, 20000]},
+        "process_TCRs": {"n_tcrs": [20000]},
+        "TCRdist_inner": {"n_tcrs": [1000], "tcrdist_cutoff": [90], "kernel": ["gather", "lut"]},
+        "TCRdist_batch": {"n_tcrs": [1, 10000], "tcrdist_cutoff": [90], "chunk_size": [500, 2000]},
+    },
+    "full": {
+        "madhyper_process": PLATE_FULL,
+        "correlation_process": PLATE_FULL,
+        "fused_process": PLATE_FULL,
+        "top3_indices": {"n_rows": [500, 1000], "n_cols": [5000, 20000, 100000]},
+        "process_TCRs": {"n_tcrs": [20000, 200000]},
+        "TCRdist_inner": {"n_tcrs": [1000, 2000], "tcrdist_cutoff": [90], "kernel": ["gather", "lut"]},
+        "TCRdist_batch": {"n_tcrs": [10000, 30000], "tcrdist_cutoff": [90, 150], "chunk_size": [500, 1000, 2000],
+                          "kernel": ["gather", "lut"]},
+    },
+}
+
+### Load inst/python/<folder>/<name>.py the way the R package does (with its own utils.py next to it)
+def import_module(folder, name):
+    path = os.path.join(PYTHON_DIR, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return(importlib.import_module(name))
+
+### Digest of an output table: rows sorted by all columns, floats rounded to 3 decimals (so backends agree)
+def digest_frame(df, h = None):
+    h = hashlib.sha1() if h is None else h
+    df = df.reset_index(drop = True)
+    cols = sorted(df.columns)
+    values = {}
+    for col in cols:
+        x = df[col].to_numpy()
+        values[col] = np.rint(x.astype(np.float64) * 1000).astype(np.int64) if np.issubdtype(x.dtype, np.floating) else x.astype(np.int64)
+    order = np.lexsort([values[col] for col in reversed(cols)]) if len(cols) > 0 else np.arange(0)
+    for col in cols:
+        h.update(col.encode())
+        h.update(np.ascontiguousarray(values[col][order]).tobytes())
+    return(h.hexdigest())
+
+def digest_array(x):
+    x = np.ascontiguousarray(x)
+    h = hashlib.sha1(repr((x.shape, str(x.dtype))).encode())
+    h.update(x.tobytes())
+    return(h.hexdigest())
+
+### MAD-HYPE score surface of a plate (as built by run_pairing), cached in data_dir since it takes a few seconds
+def mdh_surface(pairing, plate, data_dir):
+    cache_file = os.path.join(data_dir, f"mdh_{plate['n_wells']}_{plate['cpw']}_{plate['mdh_prior']:.6g}.npy")
+    if os.path.exists(cache_file):
+        return(np.load(cache_file))
+    mdh = pairing.madhyper_surface(plate["n_wells"], plate["cpw"], prior = plate["mdh_prior"])
+    os.makedirs(data_dir, exist_ok = True)
+    np.save(cache_file, mdh)
+    return(mdh)
+
+### Each setup_<target>(case, data_dir) prepares the inputs on the case's backend and returns (run, counts, check):
+### run() is the timed call, counts the problem size (pairs, TCRs) and check(output) returns (digest, output counts).
+
+def setup_plate(case, data_dir):
+    pairing = import_module("pairing", "pairing_all_backends")
+    pairing.use_backend(case["backend"])
+    plate = synthetic.simulate_plate(n_clones = case["n_clones"], n_wells = case["n_wells"], cells_per_well = case["cells_per_well"],
+                                     clone_size = case["clone_size"], dropout = case["dropout"], seed = case["seed"])
+    mdh = mdh_surface(pairing, plate, data_dir)
+    bigmas = pairing.as_input_matrix(plate["bigmas"])
+    bigmbs = pairing.as_input_matrix(plate["bigmbs"])
+    counts = {"alpha": bigmas.shape[0], "beta": bigmbs.shape[0], "pairs": bigmas.shape[0] * bigmbs.shape[0]}
+    return(pairing, bigmas, bigmbs, pairing.mx.array(mdh), counts)
+
+def setup_madhyper_process(case, data_dir):
+    pairing, bigmas, bigmbs, mdh, counts = setup_plate(case, data_dir)
+    def run():
+        return(pairing.madhyper_process("bench", data_dir, bigmas, bigmbs, mdh, chunk_size = case["chunk_size"]))
+    def check(out):
+        return(digest_frame(out), {"candidates": len(out)})
+    return(run, counts, check)
+
+def setup_correlation_process(case, data_dir):
+    pairing, bigmas, bigmbs, mdh, counts = setup_plate(case, data_dir)
+    def run():
+        return(pairing.correlation_process("bench", data_dir, bigmas, bigmbs, chunk_size = case["chunk_size"]))
+    def check(out):
+        return(digest_frame(out), {"candidates": len(out)})
+    return(run, counts, check)
+
+def setup_fused_process(case, data_dir):
+    pairing, bigmas, bigmbs, mdh, counts = setup_plate(case, data_dir)
+    def run():
+        return(pairing.fused_process("bench", data_dir, bigmas, bigmbs, mdh, chunk_size = case["chunk_size"]))
+    def check(out):
+        h = hashlib.sha1()
+        digest_frame(out[0], h)
+        return(digest_frame(out[1], h), {"candidates": len(out[0]) + len(out[1])})
+    return(run, counts, check)
+
+def setup_top3_indices(case, data_dir):
+    pairing = import_module("pairing", "pairing_all_backends")
+    mx = pairing.use_backend(case["backend"])
+    rng = np.random.default_rng(case["seed"])
+    arr = mx.array(rng.random((case["n_rows"], case["n_cols"]), dtype = np.float32))
+    def run():
+        return(pairing.to_numpy(pairing.top3_indices(arr)))
+    def check(out):
+        return(digest_array(out.astype(np.int64)), {})
+    return(run, {"pairs": case["n_rows"] * case["n_cols"]}, check)
+
+def setup_repertoire(case):
+    tcrdist = import_module("TCRdist", "TCRdist_gpu")
+    tcrdist.use_backend(case["backend"])
+    params = synthetic.load_params()
+    tcr = synthetic.simulate_repertoire(case["n_tcrs"], params = params, seed = case["seed"])
+    return(tcrdist, tcr, params)
+
+def setup_process_TCRs(case, data_dir):
+    tcrdist, tcr, params = setup_repertoire(case)
+    params_vec = dict(zip(params["feature"], params["value"]))
+    def run():
+        return(tcrdist.to_numpy(tcrdist.process_TCRs(tcr, params_vec)))
+    def check(out):
+        return(digest_array(out), {})
+    return(run, {"tcrs": len(tcr)}, check)
+
+def setup_TCRdist_inner(case, data_dir):
+    tcrdist, tcr, params = setup_repertoire(case)
+    mx = tcrdist.mx
+    params_vec = dict(zip(params["feature"], params["value"]))
+    tcrs = tcrdist.process_TCRs(tcr, params_vec)
+    submat = mx.array(synthetic.load_submat(), dtype = mx.uint8)
+    if case["kernel"] == "lut":
+        tcrs = tcrdist.to_numpy(tcrs)
+        submat = tcrdist.to_numpy(submat)
+    def run():
+        return(tcrdist.TCRdist_inner(tcrs, tcrs, submat, tcrdist_cutoff = case["tcrdist_cutoff"], compare_to_self = True,
+                                     kernel = case["kernel"]))
+    def check(out):
+        return(digest_frame(out), {"edges": len(out)})
+    return(run, {"tcrs": len(tcr), "pairs": len(tcr) * (len(tcr) - 1) // 2}, check)
+
+def setup_TCRdist_batch(case, data_dir):
+    tcrdist, tcr, params = setup_repertoire(case)
+    submat = synthetic.load_submat()
+    def run():
+        return(tcrdist.TCRdist_batch(tcr, submat, params, tcrdist_cutoff = case["tcrdist_cutoff"], chunk_size = case["chunk_size"],
+                                     kernel = case["kernel"], print_res = False, backend = case["backend"]))
+    def check(out):
+        return(digest_frame(out["TCRdist_df"]), {"edges": len(out["TCRdist_df"])})
+    return(run, {"tcrs": len(tcr), "pairs": len(tcr) * (len(tcr) - 1) // 2}, check)
+
+TARGETS = {
+    "madhyper_process": setup_madhyper_process,
+    "correlation_process": setup_correlation_process,
+    "fused_process": setup_fused_process,
+    "top3_indices": setup_top3_indices,
+    "process_TCRs": setup_process_TCRs,
+    "TCRdist_inner": setup_TCRdist_inner,
+    "TCRdist_batch": setup_TCRdist_batch,
+}
+
+### peak resident set size of this process in MB (ru_maxrss is in KB on Linux and in bytes on macOS)
+def peak_rss_mb():
+    if resource is None:
+        return(None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak / 2**20 if sys.platform == "darwin" else peak / 2**10)
+
+### Run one case: setup, warmup calls, then repeat timed calls. The functions' progress output is discarded.
+def run_case(case, repeat = 3, warmup = 0, data_dir = RESULTS_DIR):
+    with contextlib.redirect_stdout(io.StringIO()):
+        run, counts, check = TARGETS[case["target"]](case, data_dir)
+        for i in range(warmup):
+            run()
+        rss_before = peak_rss_mb()
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            out = run()
+            times.append(time.perf_counter() - t0)
+        rss_after = peak_rss_mb()
+        digest, out_counts = check(out)
+    counts = dict(counts, **out_counts)
+    wall = min(times)
+    res = {"times_s": times, "wall_s": wall, "median_s": float(np.median(times)),
+           "peak_rss_mb": rss_after, "rss_growth_mb": None if rss_after is None else rss_after - rss_before,
+           "counts": counts, "throughput": {k + "_per_s": v / wall for k, v in counts.items() if wall > 0},
+           "digest": digest}
+    return(res)
+
+def case_worker(case, repeat, warmup, data_dir, conn):
+    try:
+        res = run_case(case, repeat = repeat, warmup = warmup, data_dir = data_dir)
+    except Exception:
+        res = {"error": traceback.format_exc()}
+    conn.send(res)
+    conn.close()
+
+### Run a case in a fresh (spawned) process, so imports, caches and peak RSS of earlier cases do not carry over
+def run_case_isolated(case, repeat = 3, warmup = 0, data_dir = RESULTS_DIR):
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex = False)
+    proc = ctx.Process(target = case_worker, args = (case, repeat, warmup, data_dir, child))
+    proc.start()
+    child.close()
+    try:
+        res = parent.recv()
+    except EOFError:
+        res = {"error": f"benchmark process exited with code {proc.exitcode}"}
+    proc.join()
+    return(res)
+
+### All cases of a suite: the product of each target's grid, for every backend (and seed)
+def expand_cases(suite, targets = None, backends = ["numpy"], chunk_sizes = None, seed = 0):
+    cases = []
+    for target, grid in SUITES[suite].items():
+        if targets is not None and target not in targets:
+            continue
+        grid = dict(grid, backend = backends, seed = [seed])
+        if chunk_sizes is not None and "chunk_size" in grid:
+            grid["chunk_size"] = chunk_sizes
+        if target == "TCRdist_batch" and "kernel" not in grid:
+            grid["kernel"] = ["auto"]
+        keys = list(grid)
+        for values in itertools.product(*[grid[k] for k in keys]):
+            cases.append(dict(zip(["target"] + keys, [target] + list(values))))
+    return(cases)
+
+### Reference key of a case: the target and the parameters that define its result
+def case_key(case):
+    return(json.dumps({k: v for k, v in case.items() if k not in SWEEP_KEYS}, sort_keys = True))
+
+def git_commit():
+    try:
+        return(subprocess.run(["git", "rev-parse", "HEAD"], cwd = REPO_DIR, capture_output = True, text = True).stdout.strip() or None)
+    except OSError:
+        return(None)
+
+def environment():
+    versions = {}
+    for name in ["numpy", "scipy", "pandas", "cupy", "mlx"]:
+        try:
+            versions[name] = importlib.import_module(name).__version__
+        except Exception:
+            pass
+    return({"python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(),
+            "cpu_count": os.cpu_count(), "packages": versions, "git_commit": git_commit()})
+
+def load_reference(path):
+    if path is None or not os.path.exists(path):
+        return({})
+    with open(path) as f:
+        return(json.load(f)["cases"])
+
+### Compare each result with the reference and with the first case of the same data set in this run.
+### Sets record["check"] to "match", "new" (no reference), "mismatch", "inconsistent" or "error".
+def check_records(records, reference):
+    first = {}
+    for rec in records:
+        if "error" in rec:
+            rec["check"] = "error"
+            continue
+        key = case_key(rec["case"])
+        ref = reference.get(key)
+        if key in first and first[key]["digest"] != rec["digest"]:
+            rec["check"] = "inconsistent"
+        elif ref is None:
+            rec["check"] = "new"
+        elif ref["digest"] != rec["digest"]:
+            rec["check"] = "mismatch"
+        else:
+            rec["check"] = "match"
+        first.setdefault(key, rec)
+    return(records)
+
+def update_reference(path, records):
+    cases = load_reference(path)
+    for rec in records:
+        if rec["check"] in ["new", "match", "mismatch"]:
+            cases[case_key(rec["case"])] = {"digest": rec["digest"], "counts": rec["counts"]}
+    with open(path, "w") as f:
+        json.dump({"description": "Output digests of the benchmark cases (benchmarks/run_benchmarks.py --update-reference)",
+                   "cases": dict(sorted(cases.items()))}, f, indent = 1)
+        f.write("\n")
+
+def format_case(case):
+    return(" ".join(f"{k}={v}" for k, v in case.items() if k not in ["target", "seed"]))
+
+def format_record(rec):
+    if "error" in rec:
+        return(f"{rec['case']['target']:<20} {format_case(rec['case'])}  ERROR")
+    rate = ", ".join(f"{v:.3g} {k}" for k, v in rec["throughput"].items() if k in ["pairs_per_s", "edges_per_s", "tcrs_per_s"])
+    rss = "" if rec["peak_rss_mb"] is None else f"{rec['peak_rss_mb']:8.0f} MB"
+    return(f"{rec['case']['target']:<20} {format_case(rec['case']):<70} {rec['wall_s']:9.3f} s {rss}  {rate}  [{rec['check']}]")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks for the pairing and TCRdist Python code on synthetic data")
+    parser.add_argument("--suite", default = "quick", choices = list(SUITES))
+    parser.add_argument("--targets", default = None, help = "comma-separated subset of: " + ", ".join(TARGETS))
+    parser.add_argument("--backends", default = "numpy", help = "comma-separated backends (numpy, cupy, mlx, auto)")
+    parser.add_argument("--chunk-sizes", default = None, help = "comma-separated chunk sizes (replaces the suite's)")
+    parser.add_argument("--repeat", type = int, default = 3, help = "timed calls per case (the minimum is reported)")
+    parser.add_argument("--warmup", type = int, default = 0, help = "untimed calls per case before timing")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--out", default = None, help = "JSON file for the results (default: benchmarks/results/<suite>_<time>.json)")
+    parser.add_argument("--reference", default = REFERENCE_FILE, help = "reference digests to check the outputs against")
+    parser.add_argument("--update-reference", action = "store_true", help = "store the digests of this run in the reference file")
+    parser.add_argument("--in-process", action = "store_true", help = "run all cases in this process (peak RSS is then cumulative)")
+    parser.add_argument("--list", action = "store_true", help = "only list the cases")
+    args = parser.parse_args(argv)
+
+    targets = None if args.targets is None else args.targets.split(",")
+    unknown = [] if targets is None else [t for t in targets if t not in TARGETS]
+    if len(unknown) > 0:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+    chunk_sizes = None if args.chunk_sizes is None else [int(x) for x in args.chunk_sizes.split(",")]
+    cases = expand_cases(args.suite, targets = targets, backends = args.backends.split(","), chunk_sizes = chunk_sizes, seed = args.seed)
+    if args.list:
+        for case in cases:
+            print(f"{case['target']:<20} {format_case(case)}")
+        return(0)
+
+    data_dir = os.path.join(RESULTS_DIR, "data")
+    records = []
+    for i, case in enumerate(cases):
+        if args.in_process:
+            try:
+                res = run_case(case, repeat = args.repeat, warmup = args.warmup, data_dir = data_dir)
+            except Exception:
+                res = {"error": traceback.format_exc()}
+        else:
+            res = run_case_isolated(case, repeat = args.repeat, warmup = args.warmup, data_dir = data_dir)
+        rec = dict(case = case, **res)
+        records.append(rec)
+        check_records(records, load_reference(args.reference))
+        print(f"[{i + 1}/{len(cases)}] " + format_record(rec), flush = True)
+        if "error" in rec:
+            print(rec["error"], file = sys.stderr)
+
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok = True)
+        out = os.path.join(RESULTS_DIR, f"{args.suite}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out, "w") as f:
+        json.dump({"suite": args.suite, "timestamp": datetime.now().isoformat(timespec = "seconds"), "repeat": args.repeat,
+                   "warmup": args.warmup, "environment": environment(), "results": records}, f, indent = 1)
+        f.write("\n")
+    print(f"Results written to {out}")
+
+    if args.update_reference:
+        update_reference(args.reference, records)
+        print(f"Reference digests written to {args.reference}")
+    failed = [rec for rec in records if rec["check"] in ["mismatch", "inconsistent", "error"]]
+    if len(failed) > 0 and not args.update_reference:
+        print(f"{len(failed)} of {len(records)} cases failed the output checks:", file = sys.stderr)
+        for rec in failed:
+            print(f"  {rec['check']}: {rec['case']['target']} {format_case(rec['case'])}", file = sys.stderr)
+        return(1)
+    if any(rec["check"] in ["inconsistent", "error"] for rec in records):
+        return(1)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
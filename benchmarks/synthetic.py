@@ -0,0 +1,129 @@
+### Synthetic inputs for the benchmark suite: TIRTL-seq plates (well-occupancy matrices of paired alpha/beta chains)
+### and CDR3/V-gene repertoires for TCRdist. Everything is generated from a seed, so the same parameters always give
+### the same data (and the same outputs in the reference checks).
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTDATA_DIR = os.path.join(REPO_DIR, "inst", "extdata")
+
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+### Clone frequencies (summing to 1) for n_clones clonotypes, sorted from the largest clone down.
+### "powerlaw": Zipf-like frequencies (rank^-exponent), typical for expanded memory repertoires,
+### "lognormal": many mid-sized clones with a long tail, "uniform": all clones the same size (naive-like).
+def clone_frequencies(n_clones, clone_size = "powerlaw", rng = None, exponent = 1.1, sigma = 1.5):
+    rng = np.random.default_rng(rng)
+    if clone_size == "powerlaw":
+        freq = np.arange(1, n_clones + 1, dtype = np.float64) ** -exponent
+    elif clone_size == "lognormal":
+        freq = np.sort(rng.lognormal(0, sigma, n_clones))[::-1]
+    elif clone_size == "uniform":
+        freq = np.ones(n_clones, dtype = np.float64)
+    else:
+        raise ValueError(f"Unknown clone_size '{clone_size}', expected 'powerlaw', 'lognormal' or 'uniform'")
+    return(freq / freq.sum())
+
+### Detected chains per well: cells (counts, clones x wells CSR) each show the chain with probability 1 - dropout,
+### and the well's reads are split between detected chains with some amplification noise.
+### Returns read fractions per well as float32 CSR (clones x wells).
+def chain_reads(counts, dropout, rng, noise = 0.3):
+    counts = counts.tocoo()
+    detected = rng.binomial(counts.data, 1 - dropout)
+    keep = detected > 0
+    reads = detected[keep] * rng.lognormal(0, noise, keep.sum())
+    mat = scipy.sparse.csr_matrix((reads, (counts.row[keep], counts.col[keep])), shape = counts.shape)
+    well_total = np.asarray(mat.sum(axis = 0)).ravel()
+    well_total[well_total == 0] = 1
+    mat = mat @ scipy.sparse.diags(1 / well_total)
+    return(scipy.sparse.csr_matrix(mat, dtype = np.float32))
+
+### Simulate one TIRTL-seq plate: n_wells wells with cells_per_well T cells each, drawn from n_clones clonotypes with
+### the given clone_size distribution. Alpha and beta chains drop out independently (per cell) with probability dropout,
+### and a fraction dual_alpha of clones carry a second alpha chain.
+### As in run_pairing, only chains seen in more than min_wells wells are kept, cpw is half the average number of alpha
+### chains per well and mdh_prior is 1/sqrt(n_alpha * n_beta).
+### Returns a dict with bigmas/bigmbs (read fractions, chains x wells, rows shuffled), the true pairs (1-based alpha_nuc
+### and beta_nuc, as in the pairing output), cpw, mdh_prior and n_wells. With sparse = False the matrices are dense.
+def simulate_plate(n_clones = 100000, n_wells = 384, cells_per_well = 1000, clone_size = "powerlaw", dropout = 0.1,
+                   dual_alpha = 0.1, min_wells = 2, sparse = False, seed = 0):
+    rng = np.random.default_rng(seed)
+    n_wells = int(n_wells)
+    cells_per_well = int(cells_per_well)
+    freq = clone_frequencies(int(n_clones), clone_size, rng)
+    ### clone of every cell, well by well
+    cells = rng.choice(freq.shape[0], size = (n_wells, cells_per_well), p = freq)
+    wells = np.repeat(np.arange(n_wells), cells_per_well)
+    counts = scipy.sparse.csr_matrix((np.ones(cells.size, dtype = np.int64), (cells.ravel(), wells)),
+                                     shape = (freq.shape[0], n_wells))
+    counts.sum_duplicates()
+    beta = chain_reads(counts, dropout, rng)
+    dual = np.nonzero(rng.random(freq.shape[0]) < dual_alpha)[0]
+    alpha = scipy.sparse.vstack([chain_reads(counts, dropout, rng), chain_reads(counts[dual], dropout, rng)]).tocsr()
+    alpha_clone = np.concatenate([np.arange(freq.shape[0]), dual])
+    cpw = int(round(0.5 * alpha.nnz / n_wells))
+    ### keep chains in more than min_wells wells and shuffle rows, so pairs are not on the diagonal
+    alpha_rows = rng.permutation(np.nonzero(np.diff(alpha.indptr) > min_wells)[0])
+    beta_rows = rng.permutation(np.nonzero(np.diff(beta.indptr) > min_wells)[0])
+    alpha = alpha[alpha_rows]
+    beta = beta[beta_rows]
+    beta_pos = np.full(freq.shape[0], -1, dtype = np.int64)
+    beta_pos[beta_rows] = np.arange(beta_rows.shape[0])
+    pair_beta = beta_pos[alpha_clone[alpha_rows]]
+    paired = np.nonzero(pair_beta >= 0)[0]
+    pairs = pd.DataFrame({'alpha_nuc': paired + 1, 'beta_nuc': pair_beta[paired] + 1})
+    if not sparse:
+        alpha = alpha.toarray()
+        beta = beta.toarray()
+    mdh_prior = 1 / np.sqrt(float(alpha.shape[0]) * float(beta.shape[0]))
+    return({'bigmas': alpha, 'bigmbs': beta, 'pairs': pairs, 'cpw': cpw, 'mdh_prior': mdh_prior, 'n_wells': n_wells})
+
+### TCRdist parameters and substitution matrix as shipped with the package (TIRTLtools::params / TIRTLtools::submat)
+def load_params():
+    return(pd.read_csv(os.path.join(EXTDATA_DIR, "params_v2.tsv"), sep = "\t", header = None, names = ["feature", "value"]))
+
+def load_submat():
+    return(np.loadtxt(os.path.join(EXTDATA_DIR, "TCRdist_matrix_mega.tsv"), delimiter = "\t"))
+
+def random_cdr3(n, rng, prefix, mean_length):
+    lengths = np.clip(np.rint(rng.normal(mean_length, 2, n)).astype(int), 8, 22)
+    core = AMINO_ACIDS[rng.integers(0, AMINO_ACIDS.shape[0], (n, lengths.max()))]
+    return([prefix + "".join(core[i, :lengths[i] - len(prefix) - 1]) + "F" for i in range(n)])
+
+### Replace n_mut random positions (outside the conserved first and last residues) of each CDR3
+def mutate_cdr3(seqs, n_mut, rng):
+    out = []
+    for seq, k in zip(seqs, n_mut):
+        seq = list(seq)
+        for pos in rng.integers(1, len(seq) - 1, k):
+            seq[pos] = AMINO_ACIDS[rng.integers(0, AMINO_ACIDS.shape[0])]
+        out.append("".join(seq))
+    return(out)
+
+### Simulate a paired repertoire of n_tcrs TCRs (columns va, cdr3a, vb, cdr3b) for TCRdist.
+### V genes are drawn (with Zipf-like usage) from the genes in params; a fraction family_fraction of the TCRs belong to
+### families of about family_size members that share V genes and differ from their founder by 0-2 substitutions per CDR3,
+### so the repertoire contains realistic numbers of close neighbors (edges).
+def simulate_repertoire(n_tcrs = 10000, family_fraction = 0.3, family_size = 5, params = None, seed = 0):
+    rng = np.random.default_rng(seed)
+    if params is None:
+        params = load_params()
+    genes = params["feature"].astype(str)
+    tcr = {}
+    for chain, prefix, mean_length in [("a", "CA", 13), ("b", "CAS", 14)]:
+        v_genes = np.sort(genes[genes.str.startswith("TR" + chain.upper() + "V")].to_numpy())
+        usage = rng.permutation(np.arange(1, v_genes.shape[0] + 1) ** -1.0)
+        tcr["v" + chain] = v_genes[rng.choice(v_genes.shape[0], n_tcrs, p = usage / usage.sum())]
+        tcr["cdr3" + chain] = np.array(random_cdr3(n_tcrs, rng, prefix, mean_length), dtype = object)
+    n_members = int(n_tcrs * family_fraction)
+    n_families = max(n_members // max(int(family_size), 1), 1)
+    founders = rng.choice(n_tcrs, n_families, replace = False)
+    members = np.setdiff1d(rng.choice(n_tcrs, n_members, replace = False), founders)
+    founder = founders[rng.integers(0, n_families, members.shape[0])]
+    for chain in ["a", "b"]:
+        tcr["v" + chain][members] = tcr["v" + chain][founder]
+        tcr["cdr3" + chain][members] = mutate_cdr3(tcr["cdr3" + chain][founder], rng.integers(0, 3, members.shape[0]), rng)
+    return(pd.DataFrame({'va': tcr["va"], 'cdr3a': tcr["cdr3a"], 'vb': tcr["vb"], 'cdr3b': tcr["cdr3b"]}))
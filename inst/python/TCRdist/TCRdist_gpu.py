@@ -1,24 +1,25 @@
 # load libraries/packages --------------
 
 import utils
-gpu = utils.check_gpu()
-module = utils.check_cupy_or_mlx()
 
 import numpy as np
 import pandas as pd
 import time
 import scipy
 import os
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-if gpu == "nvidia" and module == "cupy":
-    print("Loading cupy")
-    import cupy as mx #cuda python backend, connect to T4 runtime or other with GPU
-elif gpu == "apple" and module == "mlx":
-    print("Loading mlx")
-    import mlx.core as mx #use this for apple silicon
-else:
-    print("Loading numpy")
-    import numpy as mx #use this for CPU only
+### either cupy, mlx.core, or numpy is used as "mx". The backend is resolved per call (TCRdist_batch(backend = ...))
+### by use_backend, so importing this module does not probe for a GPU. Until then mx is numpy.
+mx = np
+
+def use_backend(backend = "auto"):
+    global mx
+    mx = utils.load_backend(backend)
+    return(mx)
 
 # helper functions --------------
 
@@ -33,24 +34,302 @@ def pad_center(seq, target_length):
        second_half = seq[seq_length // 2:]
        return first_half + ['_'] * total_padding + second_half
 
-def process_TCRs(tcr, params_vec, n_max=np.inf):
-    n_max = min(n_max, tcr.shape[0])
-    cdr3amat = np.array([pad_center(list(seq), 29) for seq in tcr['cdr3a'][:n_max] ])
-    cdr3amatint = np.vectorize(params_vec.get)(cdr3amat)
-    cdr3bmat = np.array([pad_center(list(seq), 29) for seq in tcr['cdr3b'][:n_max] ])
-    cdr3bmatint = np.vectorize(params_vec.get)(cdr3bmat)
-    
+### Bulk encoding of CDR3 sequences: sequences are handled as fixed-width byte arrays, center-padded with gaps
+### ('_') to target_length one CDR3 length at a time (same result as pad_center), and mapped to parameter values with a
+### lookup table indexed by ASCII code. Returns an (n x target_length) int16 matrix.
+def encode_cdr3(seqs, params_vec, target_length = 29):
+    lut = np.full(256, -1, dtype = np.int16)
+    for feature, value in params_vec.items():
+        if isinstance(feature, str) and len(feature) == 1 and ord(feature) < 256:
+            lut[ord(feature)] = value
+    seqs = list(seqs)
+    if any(not isinstance(x, str) for x in seqs):
+        raise ValueError("CDR3 sequences must be non-missing strings")
+    try:
+        seqs = np.array(seqs, dtype = np.bytes_)
+    except UnicodeEncodeError:
+        raise ValueError("CDR3 sequences must be ASCII strings")
+    n = seqs.shape[0]
+    width = max(seqs.dtype.itemsize, 1)
+    chars = seqs.view(np.uint8).reshape(n, -1) if n > 0 else np.zeros((0, width), dtype = np.uint8)
+    lengths = np.char.str_len(seqs) if n > 0 else np.zeros(0, dtype = np.int64)
+    padded = np.full((n, target_length), ord('_'), dtype = np.uint8)
+    for seq_length in np.unique(lengths):
+        rows = np.nonzero(lengths == seq_length)[0]
+        if seq_length >= target_length:
+            padded[rows] = chars[rows, :target_length]
+        else:
+            half = seq_length // 2
+            padded[rows, :half] = chars[rows, :half]
+            padded[rows, (target_length - seq_length + half):] = chars[rows, half:seq_length]
+    encoded = lut[padded]
+    if (encoded < 0).any():
+        unknown = sorted({chr(x) for x in np.unique(padded[encoded < 0])})
+        raise ValueError(f"Unknown CDR3 characters (not in params): {unknown}")
+    return(encoded)
+
+### V genes are encoded once per distinct gene (categorical codes) instead of once per TCR
+def encode_categorical(values, params_vec):
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel = True)
+    if (codes < 0).any():
+        raise ValueError("V genes must be non-missing")
+    unknown = [x for x in uniques if x not in params_vec]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown V genes (not in params): {unknown[:10]}")
+    lut = np.array([params_vec[x] for x in uniques], dtype = np.int16)
+    return(lut[codes] if lut.shape[0] > 0 else np.zeros(len(codes), dtype = np.int16))
+
+### key for the on-disk encoding cache: hash of the encoded columns and of the parameter table
+def encoding_cache_key(tcr, params_vec):
+    h = hashlib.sha1(b"process_TCRs-v1")
+    h.update(pd.util.hash_pandas_object(tcr[['va', 'cdr3a', 'vb', 'cdr3b']], index = False).to_numpy().tobytes())
+    h.update(repr(sorted((str(k), int(v)) for k, v in params_vec.items())).encode())
+    return(h.hexdigest())
+
+### Encode TCRs as a uint8 matrix with columns va, CDR3a (truncated), vb, CDR3b (truncated).
+### With cache_dir, the encoded matrix is stored as a .npy file keyed by a hash of the input table and the parameters,
+### and loaded from there on later calls with the same TCRs. The file is written atomically (temporary file + os.replace).
+def process_TCRs(tcr, params_vec, n_max=np.inf, cache_dir = None):
+    n_max = int(min(n_max, tcr.shape[0]))
+    tcr = tcr.iloc[:n_max]
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'tcr_encoding_' + encoding_cache_key(tcr, params_vec) + '.npy')
+        if os.path.exists(cache_file):
+            return(mx.array(np.load(cache_file)).astype(mx.uint8))
     cols_to_use = slice(3, -2) #truncate CDR3s
-    
     encoded = np.column_stack([
-        np.vectorize(params_vec.get)(tcr['va'][:n_max]),
-        cdr3amatint[:,cols_to_use],
-        np.vectorize(params_vec.get)(tcr['vb'][:n_max]),
-        cdr3bmatint[:,cols_to_use]
-    ])
+        encode_categorical(tcr['va'], params_vec),
+        encode_cdr3(tcr['cdr3a'], params_vec)[:,cols_to_use],
+        encode_categorical(tcr['vb'], params_vec),
+        encode_cdr3(tcr['cdr3b'], params_vec)[:,cols_to_use]
+    ]).astype(np.uint8)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        ### write to a temporary file and move it into place, so concurrent runs never load a partly written file
+        fd, tmp_file = tempfile.mkstemp(dir = cache_dir, prefix = '.tcr_encoding_', suffix = '.npy.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, encoded)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
     tcrs=mx.array(encoded).astype(mx.uint8)
     return(tcrs)
 
+def to_numpy(x):
+    if mx.__name__ == "cupy":
+        return(mx.asnumpy(x))
+    return(np.asarray(x))
+
+### resolve the TCRdist kernel: the lookup-table kernel runs on the CPU, the gather kernel on any backend
+def resolve_kernel(kernel = "auto"):
+    if kernel == "auto":
+        return("lut" if mx.__name__ == "numpy" else "gather")
+    if kernel not in ["lut", "gather"]:
+        raise ValueError(f"Unknown kernel '{kernel}', expected 'auto', 'lut' or 'gather'")
+    return(kernel)
+
+#### Lookup-table TCRdist kernel (CPU, numpy arrays).
+#### Instead of building the (n1 x n2 x n_pos) gather submat[tcr1[:, None, :], tcr2[None, :, :]], distances are
+#### accumulated position by position into an (n1 x n2) int16 buffer (int32 if the maximum distance does not fit):
+#### for each position the submat columns of the tcr2 residues are looked up once (n_features x n2), and their rows
+#### are then gathered for each tcr1 residue. tcr1 rows are processed in blocks of block_rows to stay in cache.
+#### TCRdist_lut_blocks yields (first row, distances) for each block; the block buffer is reused between blocks.
+#### With lower_tri_offset (= ch1 - ch2 of a tile on the diagonal), each block only covers the columns that can hold
+#### pairs with node1 > node2, so diagonal tiles compute (about) the strict lower triangle only; entries of the
+#### block at or above the diagonal are still computed and have to be filtered by the caller.
+def TCRdist_lut_blocks(tcr1, tcr2, submat, block_rows = 128, lower_tri_offset = None):
+    submat = np.asarray(submat, dtype = np.uint8)
+    n1, n_pos = tcr1.shape
+    n2 = tcr2.shape[0]
+    dist_dtype = np.int16 if int(submat.max()) * n_pos <= np.iinfo(np.int16).max else np.int32
+    cols = [np.ascontiguousarray(submat[:, tcr2[:, p]]) for p in range(n_pos)]
+    buf = np.empty(min(block_rows, n1) * n2, dtype = dist_dtype)
+    tmp = np.empty(min(block_rows, n1) * n2, dtype = np.uint8)
+    for r0 in range(0, n1, block_rows):
+        r1 = min(r0 + block_rows, n1)
+        n_cols = n2 if lower_tri_offset is None else min(n2, max(0, r1 - 1 + lower_tri_offset))
+        if n_cols == 0:
+            continue
+        block = buf[:((r1 - r0) * n_cols)].reshape(r1 - r0, n_cols)
+        tmp_block = tmp[:((r1 - r0) * n_cols)].reshape(r1 - r0, n_cols)
+        block[:] = 0
+        for p in range(n_pos):
+            np.take(cols[p] if n_cols == n2 else cols[p][:, :n_cols], tcr1[r0:r1, p], axis = 0, out = tmp_block)
+            block += tmp_block
+        yield(r0, block)
+
+def TCRdist_lut(tcr1, tcr2, submat, block_rows = 128, lower_tri_offset = None):
+    submat = np.asarray(submat, dtype = np.uint8)
+    dist_dtype = np.int16 if int(submat.max()) * tcr1.shape[1] <= np.iinfo(np.int16).max else np.int32
+    result = np.zeros((tcr1.shape[0], tcr2.shape[0]), dtype = dist_dtype)
+    for r0, block in TCRdist_lut_blocks(tcr1, tcr2, submat, block_rows = block_rows, lower_tri_offset = lower_tri_offset):
+        result[r0:(r0 + block.shape[0]), :block.shape[1]] = block
+    return(result)
+
+#### Edge list (same columns and row-major order as TCRdist_inner) from a dense block of distances
+def TCRdist_edges(result, tcrdist_cutoff = 90, ch1 = 0, ch2 = 0, only_lower_tri = True, compare_to_self = False):
+    rows, cols = np.divmod(np.flatnonzero(result <= tcrdist_cutoff), result.shape[1])
+    dist = result[rows, cols]
+    rows = rows.astype(np.int32) + ch1
+    cols = cols.astype(np.int32) + ch2
+    if compare_to_self:
+        keep = rows > cols if only_lower_tri else rows != cols
+        rows, cols, dist = rows[keep], cols[keep], dist[keep]
+    return(pd.DataFrame({'node1_0index': rows, 'node2_0index': cols, 'TCRdist': dist.astype(np.int32)}))
+
+#### Lower-bound encoding for TCRdist_pruned. Columns of tcr1/tcr2 are laid out as in process_TCRs: va, CDR3a, vb, CDR3b.
+#### TCRdist is a sum of non-negative submat entries, so a lower bound is
+####  1. the exact partial sum over the V-gene columns and the first n_prefix CDR3 columns of each chain, plus
+####  2. a CDR3 length bound over the remaining CDR3 columns of each chain: wherever one CDR3 has a gap (gap_code, from
+####     the center padding in pad_center) and the other a residue, the cost is at least gap_cost (the cheapest gap/residue
+####     entry of submat), and there are at least |gaps1 - gaps2| such columns.
+#### The gap counts are encoded as extra columns with codes after those of submat, and the table is extended with
+#### gap_cost * |gaps1 - gaps2| (capped at 255, which only lowers the bound), so the whole bound is one lookup-table sum.
+#### Returns the extended table and the bound columns for tcr1 and tcr2.
+def TCRdist_bound_encoding(tcr1, tcr2, submat, gap_code = None, n_prefix = 3):
+    submat = np.asarray(submat, dtype = np.uint8)
+    gap_cost = 0
+    if gap_code is not None:
+        gap_cost = TCRdist_gap_cost(submat, gap_code, np.union1d(cdr3_residues(tcr1), cdr3_residues(tcr2)))
+    table = TCRdist_bound_table(submat, gap_cost, n_cdr3 = (tcr1.shape[1] - 2) // 2)
+    return(table,
+           TCRdist_bound_columns(tcr1, submat.shape[0], gap_code = gap_code if gap_cost > 0 else None, n_prefix = n_prefix),
+           TCRdist_bound_columns(tcr2, submat.shape[0], gap_code = gap_code if gap_cost > 0 else None, n_prefix = n_prefix))
+
+### the CDR3 columns of each chain in the encoding of process_TCRs
+def cdr3_columns(n_pos):
+    n_cdr3 = (n_pos - 2) // 2
+    return([list(range(1, 1 + n_cdr3)), list(range(2 + n_cdr3, n_pos))])
+
+### the distinct codes in the CDR3 columns
+def cdr3_residues(tcrs):
+    cols = cdr3_columns(tcrs.shape[1])
+    return(np.unique(tcrs[:, cols[0] + cols[1]]))
+
+### cheapest gap/residue entry of submat over the residues that occur (0 if there are none)
+def TCRdist_gap_cost(submat, gap_code, residues):
+    residues = np.setdiff1d(residues, [gap_code])
+    if residues.shape[0] == 0:
+        return(0)
+    return(int(min(submat[gap_code, residues].min(), submat[residues, gap_code].min())))
+
+### submat extended with the gap-count block (codes n_codes ... n_codes + n_cdr3), see TCRdist_bound_encoding
+def TCRdist_bound_table(submat, gap_cost, n_cdr3):
+    n_codes = submat.shape[0]
+    if n_codes + n_cdr3 >= 256:
+        return(submat)
+    gaps = np.arange(n_cdr3 + 1)
+    table = np.zeros((n_codes + n_cdr3 + 1, n_codes + n_cdr3 + 1), dtype = np.uint8)
+    table[:n_codes, :n_codes] = submat
+    table[n_codes:, n_codes:] = np.minimum(max(gap_cost, 0) * np.abs(gaps[:, None] - gaps[None, :]), 255)
+    return(table)
+
+### bound columns: the V-gene and first n_prefix CDR3 columns, and (with gap_code) the gap count of the remaining
+### CDR3 columns of each chain, coded after the n_codes codes of submat
+def TCRdist_bound_columns(tcrs, n_codes, gap_code = None, n_prefix = 3):
+    cdr3_cols = cdr3_columns(tcrs.shape[1])
+    n_cdr3 = len(cdr3_cols[0])
+    bound = [tcrs[:, [0, 1 + n_cdr3] + cdr3_cols[0][:n_prefix] + cdr3_cols[1][:n_prefix]]]
+    if gap_code is not None and n_codes + n_cdr3 < 256:
+        for cols in cdr3_cols:
+            bound.append(n_codes + (tcrs[:, cols[n_prefix:]] == gap_code).sum(axis = 1, keepdims = True))
+    return(np.hstack(bound).astype(np.uint8))
+
+#### Pruned thresholded TCRdist (CPU, numpy arrays), returns the same edge list as TCRdist_edges(TCRdist_lut(...)).
+#### The lower bound from TCRdist_bound_encoding (bound_table, bound1, bound2) is computed for all pairs with the
+#### lookup-table kernel, and only pairs with a bound <= tcrdist_cutoff are scored in full.
+#### Counts of pairs in the search, pruned and scored are added to stats.
+def TCRdist_pruned(tcr1, tcr2, submat, bound_table, bound1, bound2, tcrdist_cutoff = 90,
+                   ch1 = 0, ch2 = 0, only_lower_tri = True, compare_to_self = False, stats = None, block_rows = 128):
+    n1 = tcr1.shape[0]
+    n2 = tcr2.shape[0]
+    rows = []
+    cols = []
+    lower_tri_offset = ch1 - ch2 if compare_to_self and only_lower_tri else None
+    with utils.stage_timer("bound"):
+        for r0, block in TCRdist_lut_blocks(bound1, bound2, bound_table, block_rows = block_rows, lower_tri_offset = lower_tri_offset):
+            viable = np.flatnonzero(block <= tcrdist_cutoff)
+            rows.append(viable // block.shape[1] + r0)
+            cols.append(viable % block.shape[1])
+        rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype = np.int64)
+        cols = np.concatenate(cols) if len(cols) > 0 else np.zeros(0, dtype = np.int64)
+    n_pairs = n1 * n2
+    if compare_to_self:
+        shift = np.arange(n1) + ch1 - ch2 ### node1 - ch2, for each row
+        if only_lower_tri:
+            n_pairs = int(np.clip(shift, 0, n2).sum())
+            keep = rows + ch1 > cols + ch2
+        else:
+            n_pairs = n1 * n2 - int(np.count_nonzero((shift >= 0) & (shift < n2)))
+            keep = rows + ch1 != cols + ch2
+        rows, cols = rows[keep], cols[keep]
+    with utils.stage_timer("gather"):
+        dist = np.zeros(rows.shape[0], dtype = np.int32)
+        for p in range(tcr1.shape[1]):
+            dist += submat[tcr1[rows, p], tcr2[cols, p]]
+    keep = dist <= tcrdist_cutoff
+    if stats is not None:
+        stats['n_pairs'] += n_pairs
+        stats['n_pruned'] += n_pairs - rows.shape[0]
+        stats['n_scored'] += rows.shape[0]
+    with utils.stage_timer("assemble"):
+        res = pd.DataFrame({'node1_0index': rows[keep].astype(np.int32) + ch1,
+                            'node2_0index': cols[keep].astype(np.int32) + ch2,
+                            'TCRdist': dist[keep]})
+    return(res)
+
+#### Deduplication: TCRs with identical encodings (after the CDR3 truncation) have identical distances to all other TCRs,
+#### so the search can run on the unique rows only. Returns the unique encoded rows and, for each TCR, its unique row.
+def unique_TCRs(tcrs):
+    unique, inverse = np.unique(to_numpy(tcrs), axis = 0, return_inverse = True)
+    return(mx.array(unique) if mx.__name__ != "numpy" else unique, inverse.reshape(-1))
+
+### for each unique row: the TCRs that map to it are order[start:(start + size)]
+def group_members(inverse):
+    order = np.argsort(inverse, kind = "stable")
+    size = np.bincount(inverse)
+    start = np.cumsum(size) - size
+    return(order, start, size)
+
+### Expand the edges over unique TCRs (u, v, dist) to the original TCR indices (node1 from inverse1, node2 from inverse2),
+### adding the edges between identical TCRs (distance self_dist of their unique row) when comparing to self.
+### Yields one data frame per block of chunk_size original node1 indices, so only one block of expanded edges is in memory;
+### together the blocks give the edges in the order TCRdist_batch produces without deduplication for the same chunk sizes.
+def expand_edge_blocks(u, v, dist, inverse1, inverse2, self_dist, tcrdist_cutoff = 90, compare_to_self = False, only_lower_tri = True,
+                       chunk_size = 1000, chunk_size_col = 1000):
+    order2, start2, size2 = group_members(inverse1 if compare_to_self else inverse2)
+    if compare_to_self:
+        if only_lower_tri: ### edges are stored once (u > v); expand them from both ends and keep node1 > node2
+            u, v, dist = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([dist, dist])
+        dup = np.nonzero((size2 > 1) & (self_dist <= tcrdist_cutoff))[0]
+        u, v, dist = np.concatenate([u, dup]), np.concatenate([v, dup]), np.concatenate([dist, self_dist[dup]])
+    by_u = np.argsort(u, kind = "stable")
+    v = v[by_u]
+    dist = dist[by_u]
+    u_count = np.bincount(u, minlength = self_dist.shape[0])
+    u_start = np.cumsum(u_count) - u_count
+    for ch in range(0, inverse1.shape[0], chunk_size):
+        a = np.arange(ch, min(ch + chunk_size, inverse1.shape[0]))
+        n_edges = u_count[inverse1[a]]
+        node1 = np.repeat(a, n_edges)
+        e = np.repeat(u_start[inverse1[a]] - (np.cumsum(n_edges) - n_edges), n_edges) + np.arange(n_edges.sum())
+        n_members = size2[v[e]]
+        edge = np.repeat(e, n_members)
+        k = np.arange(n_members.sum()) - np.repeat(np.cumsum(n_members) - n_members, n_members)
+        node1 = np.repeat(node1, n_members)
+        node2 = order2[start2[v[edge]] + k]
+        if compare_to_self:
+            keep = node1 > node2 if only_lower_tri else node1 != node2
+            node1, node2, edge = node1[keep], node2[keep], edge[keep]
+        order = np.lexsort((node2, node1, node2 // chunk_size_col))
+        yield(pd.DataFrame({'node1_0index': node1[order].astype(np.int32),
+                            'node2_0index': node2[order].astype(np.int32),
+                            'TCRdist': dist[edge][order].astype(np.int32)}))
+
 #### Naive no-loop TCRdist function for GPU with sparse output -- either sparse csr_matrix or pandas dataframe
 #### Returns only edges with TCRdist less than or equal to cutoff (default = 90)
 #### Returns dataframe with 3 columns: 'row' (row_index), 'col' (column index), and 'TCRdist' (TCRdist value)
@@ -58,53 +337,132 @@ def process_TCRs(tcr, params_vec, n_max=np.inf):
 def TCRdist_inner(tcr1, tcr2, submat, tcrdist_cutoff=90, 
                   ch1=0, ch2=0, output = "edge_list",
                   only_lower_tri = True,
-                  compare_to_self = False):
-    result = mx.sum(submat[tcr1[:, None, :], tcr2[ None,:, :]],axis=2)
-    ### set values with TCRdist == 0 to negative 1 so that they are not lost when converted to sparse matrix
-    mask = result == 0
-    mask = mask*(-1)
-    result = result+mask
-    ## set values greater than the cutoff to zero
-    less_or_equal = mx.less_equal(result, tcrdist_cutoff)
-    result = result*less_or_equal
+                  compare_to_self = False,
+                  kernel = "gather"):
+    if kernel == "lut":
+        with utils.stage_timer("gather"):
+            result = TCRdist_lut(tcr1, tcr2, submat, lower_tri_offset = ch1 - ch2 if compare_to_self and only_lower_tri else None)
+        if output == "edge_list":
+            with utils.stage_timer("threshold"):
+                edges = TCRdist_edges(result, tcrdist_cutoff = tcrdist_cutoff, ch1 = ch1, ch2 = ch2,
+                                      only_lower_tri = only_lower_tri, compare_to_self = compare_to_self)
+            return(edges)
+    else:
+        with utils.stage_timer("gather"):
+            result = mx.sum(submat[tcr1[:, None, :], tcr2[ None,:, :]],axis=2)
+    with utils.stage_timer("threshold"):
+        ### set values with TCRdist == 0 to negative 1 so that they are not lost when converted to sparse matrix
+        mask = result == 0
+        mask = mask*(-1)
+        result = result+mask
+        ## set values greater than the cutoff to zero
+        less_or_equal = mx.less_equal(result, tcrdist_cutoff)
+        result = result*less_or_equal
     if mx.__name__ == "cupy":
-        result = mx.asnumpy(result)
-    if output in ["sparse", "both", "edge_list"]:
-        #score_dtype = np.int16
-        score_dtype = np.int32
-        #if tcrdist_cutoff <= 255:
-        #    score_dtype = np.uint16
-        ### convert matrix to sparse (gets rid of all zero values)
-        result_sparse = scipy.sparse.csr_matrix(result, dtype = score_dtype)
-    if output in ["edge_list", "both"]:
-        ### convert matrix to dataframe with indices and TCRdist values
-        coo_mat = result_sparse.tocoo()
-        df = pd.DataFrame({'node1_0index': coo_mat.row+ch1, 'node2_0index': coo_mat.col+ch2, 'TCRdist': coo_mat.data})
-        if compare_to_self:
-            if only_lower_tri:
-                df = df[df['node1_0index'] > df['node2_0index']]
-            else:
-                df = df[df['node1_0index'] != df['node2_0index']]
-        ### Change values of -1 back to zero (see comment above)
-        df['TCRdist'] = df['TCRdist'].replace(-1, 0)
-    if output == "both":
-        return(result_sparse, df)
-    elif output == "edge_list":
-        return(df)
-    elif output == "sparse":
-        return(result_sparse)
+        with utils.stage_timer("transfer"):
+            result = mx.asnumpy(result)
+    with utils.stage_timer("assemble"):
+        if output in ["sparse", "both", "edge_list"]:
+            #score_dtype = np.int16
+            score_dtype = np.int32
+            #if tcrdist_cutoff <= 255:
+            #    score_dtype = np.uint16
+            ### convert matrix to sparse (gets rid of all zero values)
+            result_sparse = scipy.sparse.csr_matrix(result, dtype = score_dtype)
+        if output in ["edge_list", "both"]:
+            ### convert matrix to dataframe with indices and TCRdist values
+            coo_mat = result_sparse.tocoo()
+            df = pd.DataFrame({'node1_0index': coo_mat.row+ch1, 'node2_0index': coo_mat.col+ch2, 'TCRdist': coo_mat.data})
+            if compare_to_self:
+                if only_lower_tri:
+                    df = df[df['node1_0index'] > df['node2_0index']]
+                else:
+                    df = df[df['node1_0index'] != df['node2_0index']]
+            ### Change values of -1 back to zero (see comment above)
+            df['TCRdist'] = df['TCRdist'].replace(-1, 0)
+        if output == "both":
+            return(result_sparse, df)
+        elif output == "edge_list":
+            return(df)
+        elif output == "sparse":
+            return(result_sparse)
     
 
+### Tiles (ch, chunk_end, ch2, chunk_end2) of the (n1 x n2) search, in the order their edges are returned:
+### row chunks of chunk_size, and within each, column chunks of chunk_size_col.
+### With lower_tri (compare_to_self and only_lower_tri), only tiles holding at least one pair with node1 > node2 are kept.
+def tile_schedule(n1, n2, chunk_size, chunk_size_col, lower_tri = False):
+    tiles = []
+    for ch in range(0, n1, chunk_size):
+        chunk_end = min(ch + chunk_size, n1)
+        for ch2 in range(0, n2, chunk_size_col):
+            if lower_tri and chunk_end - 1 <= ch2:
+                continue
+            tiles.append((ch, chunk_end, ch2, min(ch2 + chunk_size_col, n2)))
+    return(tiles)
+
+### Run tile_fn on every tile with a pool of n_workers threads (the numpy kernels release the GIL, and the encoded
+### TCRs are shared by all threads without copies). At most 2 x n_workers tiles are in flight, and results are
+### yielded in tile order, so output and progress are the same as for a serial run.
+### With stats (utils.PipelineStats), the stage times of each tile are recorded in its thread and added to stats as
+### the tile is yielded.
+def run_tiles(tile_fn, tiles, n_workers = 1, stats = None):
+    if n_workers <= 1:
+        for tile in tiles:
+            yield tile_fn(tile) if stats is None else stats.run_chunk(tile_fn, tile)
+        return
+    def result(future):
+        if stats is None:
+            return(future.result())
+        res, times = future.result()
+        stats.add_times(times)
+        return(res)
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        pending = deque()
+        for tile in tiles:
+            if stats is None:
+                pending.append(executor.submit(tile_fn, tile))
+            else:
+                pending.append(executor.submit(utils.collect_stage_times, tile_fn, tile, sync = stats.sync))
+            if len(pending) >= 2 * n_workers:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
 ### TCRdist function for GPU with batching for tcr1 and tcr2 lists and sparse output
 ### Returns a pandas data frame of all edges with TCRdist less than cutoff (default = 90)
 ### Returns dataframe with 3 columns: 'row' (row_index), 'col' (column index), and 'TCRdist' (TCRdist value)
-def TCRdist_batch(tcr1, submat, params_df, tcr2=None, tcrdist_cutoff=90, chunk_size=1000, chunk_size_col = None, print_chunk_size=10, print_res = True, only_lower_tri = True, write_to_tsv=False, output_folder = ".", return_data = True):
+### With write_to_tsv, edges are appended to output_folder/TCRdist_df.tsv chunk by chunk, or streamed to
+### TCRdist_df.parquet / TCRdist_df.arrow (compact integer columns, needs pyarrow) with output_format = "parquet" / "arrow"
+### kernel = "auto" uses the lookup-table kernel (TCRdist_lut) on the numpy backend and the 3-D gather on GPU backends
+### prune = True (LUT kernel only) skips pairs whose lower bound exceeds the cutoff (TCRdist_pruned); the counts of
+### pruned pairs are printed and kept in the attrs['TCRdist_search'] of the returned TCRdist_df
+### dedup = True runs the search on unique encoded TCRs only and expands the edges to all TCRs afterwards, with the same
+### output; the expanded edges are produced and written in blocks of chunk_size rows (expand_edge_blocks) and only kept
+### in memory with return_data
+### n_workers threads process tiles in parallel with the LUT kernel (0 = all cores); tiles are enumerated by tile_schedule
+### cache_dir (optional) keeps the encoded TCRs on disk (see process_TCRs), so repeated runs on the same TCRs skip encoding
+### Stage times, per-tile counts and memory are recorded in a utils.PipelineStats (progress events every print_chunk_size
+### percent, JSON lines appended to stats_file, callback called with each event) and returned as 'stats'; a stats
+### object passed in (as by TCRdist_append) is added to and left open.
+def TCRdist_batch(tcr1, submat, params_df, tcr2=None, tcrdist_cutoff=90, chunk_size=1000, chunk_size_col = None, print_chunk_size=10, print_res = True, only_lower_tri = True, write_to_tsv=False, output_folder = ".", return_data = True, output_format = "tsv", kernel = "auto", prune = True, cache_dir = None, dedup = False, n_workers = 1, backend = "auto", stats_file = None, callback = None, stats = None):
+    use_backend(backend)
+    own_stats = stats is None
+    if own_stats:
+        stats = utils.PipelineStats("TCRdist", log_file = stats_file, callback = callback, progress_step = int(print_chunk_size), backend = mx)
+        stats.set_phase("TCRdist")
     #chunk_size = np.int64(chunk_size)
     #print_chunk_size = np.int64(print_chunk_size)
     compare_to_self = False
+    if output_format not in ["tsv", "parquet", "arrow"]:
+        raise ValueError(f"Unknown output_format '{output_format}', expected 'tsv', 'parquet' or 'arrow'")
+    kernel = resolve_kernel(kernel)
     submat = mx.array(submat, dtype = mx.uint8)
     params_vec = dict(zip(params_df["feature"], params_df["value"]))
-    tcr1_mx = process_TCRs(tcr1, params_vec=params_vec)
+    prune = prune and kernel == "lut"
+    search = {'n_pairs': 0, 'n_pruned': 0, 'n_scored': 0}
+    with stats.stage("encode"):
+        tcr1_mx = process_TCRs(tcr1, params_vec=params_vec, cache_dir=cache_dir)
     tcr1 = tcr1.copy()
     tcr1['tcr_index'] = range(len(tcr1))
     if tcr2 is None:
@@ -112,60 +470,81 @@ def TCRdist_batch(tcr1, submat, params_df, tcr2=None, tcrdist_cutoff=90, chunk_s
         tcr2_mx = tcr1_mx
     else:
         tcr2 = tcr2.copy()
-        tcr2_mx = process_TCRs(tcr2, params_vec=params_vec)
+        with stats.stage("encode"):
+            tcr2_mx = process_TCRs(tcr2, params_vec=params_vec, cache_dir=cache_dir)
         tcr2['tcr_index'] = range(len(tcr1), len(tcr1) + len(tcr2))
     if write_to_tsv:
         os.makedirs(output_folder, exist_ok=True)
-        output_file_edges = os.path.join(output_folder, 'TCRdist_df.tsv')
+        output_file_edges = os.path.join(output_folder, 'TCRdist_df' + utils.output_extension(output_format))
         output_file_tcr1 = os.path.join(output_folder, 'tcr1.tsv')
         tcr1.to_csv(output_file_tcr1, sep='\t', header=True, index=False)
         if tcr2 is not None:
             output_file_tcr2 = os.path.join(output_folder, 'tcr2.tsv')
             tcr2.to_csv(output_file_tcr2, sep='\t', header=True, index=False)
+    if kernel == "lut":
+        with stats.stage("transfer"):
+            submat = to_numpy(submat)
+            tcr1_mx = to_numpy(tcr1_mx)
+            tcr2_mx = tcr1_mx if compare_to_self else to_numpy(tcr2_mx)
     n1 = tcr1_mx.shape[0]
     n2 = tcr2_mx.shape[0]
-    num_chunks1 = np.int64(np.ceil(n1//chunk_size))
+    writer = None
+    if write_to_tsv and output_format != "tsv":
+        index_dtype = np.int32 if max(n1, n2) < np.iinfo(np.int32).max else np.int64
+        writer = utils.ChunkWriter(output_file_edges, {'node1_0index': index_dtype, 'node2_0index': index_dtype, 'TCRdist': np.int16}, output_format)
     if chunk_size_col is None:
         chunk_size_col = chunk_size
     else:
         chunk_size_col = min(chunk_size_col, n2)
-    num_chunks2 = np.int64(np.ceil(n2//chunk_size_col))
-    # if print_res:
-    #     print('total number of chunks (rows):', num_chunks1)
-    #     print('total number of chunks (cols):', num_chunks2)
+    if dedup:
+        with stats.stage("encode"):
+            tcr1_mx, inverse1 = unique_TCRs(tcr1_mx)
+            tcr2_mx, inverse2 = (tcr1_mx, inverse1) if compare_to_self else unique_TCRs(tcr2_mx)
+            self_dist = to_numpy(submat)[to_numpy(tcr1_mx), to_numpy(tcr1_mx)].sum(axis = 1)
+        print(f"Unique TCRs: {tcr1_mx.shape[0]} of {n1}" + ("" if compare_to_self else f" (tcr1), {tcr2_mx.shape[0]} of {n2} (tcr2)"))
+        n1 = tcr1_mx.shape[0]
+        n2 = tcr2_mx.shape[0]
+    if own_stats:
+        stats.set_info(n1 = n1, n2 = n2, kernel = kernel, prune = prune, dedup = dedup, chunk_size = chunk_size, chunk_size_col = chunk_size_col)
+    if prune:
+        with stats.stage("bound"):
+            bound_table, bound1, bound2 = TCRdist_bound_encoding(tcr1_mx, tcr2_mx, submat, gap_code = params_vec.get('_'))
+    n_workers = os.cpu_count() if n_workers is None or int(n_workers) < 1 else int(n_workers)
+    if n_workers > 1 and kernel != "lut":
+        print(f"n_workers is only used with the lut kernel, running serially on {mx.__name__}")
+        n_workers = 1
+    tiles = tile_schedule(n1, n2, chunk_size, chunk_size_col, lower_tri = compare_to_self and only_lower_tri)
+    def tile_fn(tile):
+        ch, chunk_end, ch2, chunk_end2 = tile
+        row_range1 = slice(ch, chunk_end)
+        row_range2 = slice(ch2, chunk_end2)
+        tile_search = {'n_pairs': 0, 'n_pruned': 0, 'n_scored': 0}
+        if prune:
+            edges_tmp = TCRdist_pruned(tcr1=tcr1_mx[row_range1,:], tcr2=tcr2_mx[row_range2,:], submat=submat, bound_table=bound_table,
+                                       bound1=bound1[row_range1], bound2=bound2[row_range2],
+                                       tcrdist_cutoff=tcrdist_cutoff, ch1=ch, ch2=ch2, only_lower_tri = only_lower_tri,
+                                       compare_to_self = compare_to_self, stats = tile_search)
+        else:
+            edges_tmp = TCRdist_inner(tcr1=tcr1_mx[row_range1,:], tcr2=tcr2_mx[row_range2,:], submat=submat,
+                                       tcrdist_cutoff=tcrdist_cutoff,
+                                       ch1=ch, ch2=ch2, output="edge_list", only_lower_tri = only_lower_tri,
+                                       compare_to_self = compare_to_self, kernel = kernel)
+        return(edges_tmp, tile_search)
     start_time = time.time()
     res_list = []
+    unique_list = []
     first_write = True
-    i=0
-    n_chunks = len(range(0, n1, chunk_size))*len(range(0, n2, chunk_size_col))
-    if compare_to_self and only_lower_tri:
-        n_chunks = np.int64(np.floor((n_chunks - len(range(0, n1, chunk_size)))/2))
+    n_chunks = len(tiles)
     print('Number of chunks: ' + str(n_chunks))
-    print_chunk_size = int(print_chunk_size)
-    if 1 <= print_chunk_size <= 99:
-        milestones = {int(n_chunks * p / 100) for p in range(print_chunk_size, 101, print_chunk_size)}
-    else:
-        milestones = {int(n_chunks * p / 100) for p in range(10, 101, 10)}  # positions for 10%, 20%, ..
-    for ch in range(0, n1, chunk_size):
-        # if print_res:
-        #     if ch % print_chunk_size == 0:
-        #         print('Processing chunk (rows)', ch)
-        chunk_end = min(ch + chunk_size, n1)
-        row_range1 = slice(ch, chunk_end)
-        tcr1_tmp = tcr1_mx[row_range1,:]
-        for ch2 in range(0, n2, chunk_size_col):
-            if compare_to_self and ch < ch2 and only_lower_tri:
-                continue
-            i = i + 1
-            n_percent = np.floor(n_chunks/i)
-            chunk_end2 = min(ch2 + chunk_size_col, n2)
-            row_range2 = slice(ch2, chunk_end2)
-            tcr2_tmp = tcr2_mx[row_range2,:]
-            edges_tmp = TCRdist_inner(tcr1=tcr1_tmp, tcr2=tcr2_tmp, submat=submat,
-                                       tcrdist_cutoff=tcrdist_cutoff,
-                                       ch1=ch, ch2=ch2, output="edge_list", only_lower_tri = only_lower_tri,
-                                       compare_to_self = compare_to_self)
-            if write_to_tsv:
+    for i, (edges_tmp, tile_search) in enumerate(run_tiles(tile_fn, tiles, n_workers = n_workers, stats = stats)):
+        for key in tile_search:
+            search[key] += tile_search[key]
+        with stats.stage("write"):
+            if dedup: ### written after expanding the edges
+                pass
+            elif writer is not None:
+                writer.write(edges_tmp)
+            elif write_to_tsv:
                 edges_tmp.to_csv(
                     output_file_edges,
                     sep='\t',
@@ -174,30 +553,326 @@ def TCRdist_batch(tcr1, submat, params_df, tcr2=None, tcrdist_cutoff=90, chunk_s
                     index=False
                 )
                 first_write=False
+        if dedup:
+            unique_list.append(edges_tmp)
+        elif return_data:
+            res_list.append(edges_tmp)
+        ch, chunk_end, ch2, chunk_end2 = tiles[i]
+        percent = stats.chunk(i, n_chunks, pairs_evaluated = tile_search['n_pairs'] if prune else (chunk_end - ch) * (chunk_end2 - ch2),
+                              pairs_scored = tile_search['n_scored'] if prune else (chunk_end - ch) * (chunk_end2 - ch2), edges = edges_tmp.shape[0])
+        if print_res and percent is not None:
+            print(f"{percent}% done")
+            print(f"Time taken so far: {time.time() - start_time:.6f} seconds")
+    if dedup:
+        with stats.stage("assemble"):
+            edges = pd.concat(unique_list) if len(unique_list) > 0 else pd.DataFrame({'node1_0index': [], 'node2_0index': [], 'TCRdist': []}, dtype = np.int32)
+            del unique_list
+            blocks = expand_edge_blocks(edges['node1_0index'].to_numpy().astype(np.int64), edges['node2_0index'].to_numpy().astype(np.int64),
+                                        edges['TCRdist'].to_numpy(), inverse1, inverse2, self_dist, tcrdist_cutoff = tcrdist_cutoff,
+                                        compare_to_self = compare_to_self, only_lower_tri = only_lower_tri,
+                                        chunk_size = chunk_size, chunk_size_col = chunk_size_col)
+            del edges
+        while True:
+            with stats.stage("assemble"):
+                block = next(blocks, None)
+            if block is None:
+                break
+            with stats.stage("write"):
+                if writer is not None:
+                    writer.write(block)
+                elif write_to_tsv:
+                    block.to_csv(output_file_edges, sep='\t', mode='a', header=first_write, index=False)
+                    first_write = False
             if return_data:
-                res_list.append(edges_tmp)
-            if print_res:
-                # if i % print_chunk_size == 0:
-                #     print(f"Processing chunk {i}")
-                if (i + 1) in milestones:
-                    percent = round((i + 1) * 100 / n_chunks)
-                    print(f"{percent}% done")
-                    end_time_chunk = time.time()
-                    print(f"Time taken so far: {end_time_chunk - start_time:.6f} seconds")
+                res_list.append(block)
+    if writer is not None:
+        with stats.stage("write"):
+            writer.close()
+        print(f"Wrote {writer.n_rows} edges to {output_file_edges}")
+    if prune and search['n_pairs'] > 0:
+        search['fraction_pruned'] = 1 - search['n_scored'] / search['n_pairs']
+        print(f"Fraction of pairs pruned: {search['fraction_pruned']:.4f} (pruned: {search['n_pruned']}, scored: {search['n_scored']})")
+    if prune and own_stats:
+        stats.set_info(TCRdist_search = search)
     if return_data:
-        res = pd.concat(res_list)
-        res.reset_index(inplace=True)
-        res = res.drop('index', axis=1)
+        with stats.stage("assemble"):
+            res = pd.concat(res_list) if len(res_list) > 0 else pd.DataFrame({'node1_0index': [], 'node2_0index': [], 'TCRdist': []}, dtype = np.int32)
+            res.reset_index(inplace=True)
+            res = res.drop('index', axis=1)
         if print_res and return_data:
             res
+        if prune:
+            res.attrs['TCRdist_search'] = search
         if compare_to_self:
             res_dict = {'TCRdist_df': res, 'tcr1': tcr1}
         else:
             res['node2_0index'] = res['node2_0index'] + len(tcr1)
             res_dict = { 'TCRdist_df': res, 'tcr1': tcr1, 'tcr2': tcr2}
+        if own_stats:
+            res_dict['stats'] = stats.close()
         out = res_dict
     else:
         out = None
+        if own_stats:
+            stats.close()
     end_time = time.time()
     print(f"Total time taken: {end_time - start_time:.6f} seconds")
     return(out)
+
+
+### Incremental TCRdist ------------------------------------------------------------------------------------------
+### Add new TCRs to an existing all-vs-all result of TCRdist_batch (tcr2 = None) without recomputing the old edges:
+### only the new-vs-old tiles (TCRdist_batch(tcr_new, tcr2 = old TCRs)) and the new-vs-new tiles
+### (TCRdist_batch(tcr_new)) are calculated. The new TCRs get tcr_index len(old) ... len(old) + len(new) - 1, and
+### their edges are remapped to these indices, so the result is the same edge set as TCRdist_batch on the combined
+### table (old edges first, then the new edges sorted by node1, node2).
+### store is either the dict returned by TCRdist_batch (or TCRdist_append) with 'TCRdist_df' and 'tcr1', or the
+### output_folder of TCRdist_batch(write_to_tsv = True). For a folder, the new edges are appended to its
+### TCRdist_df file (Parquet/Arrow files are rewritten, copying the old edges batch by batch) and tcr1.tsv is updated.
+### Both searches record into one utils.PipelineStats (phases "new_vs_old" and "new_vs_new"), returned as 'stats'.
+def TCRdist_append(store, tcr_new, submat, params_df, tcrdist_cutoff=90, chunk_size=1000, chunk_size_col = None, print_chunk_size=10, print_res = True, only_lower_tri = True, return_data = True, output_format = "tsv", kernel = "auto", prune = True, cache_dir = None, dedup = False, n_workers = 1, backend = "auto", stats_file = None, callback = None):
+    start_time = time.time()
+    stats = utils.PipelineStats("TCRdist_append", log_file = stats_file, callback = callback, progress_step = int(print_chunk_size), backend = use_backend(backend))
+    folder = store if isinstance(store, str) else None
+    if folder is not None:
+        output_file_edges = os.path.join(folder, 'TCRdist_df' + utils.output_extension(output_format))
+        output_file_tcr1 = os.path.join(folder, 'tcr1.tsv')
+        if os.path.exists(os.path.join(folder, 'tcr2.tsv')):
+            raise ValueError(f"'{folder}' holds a result for two sets of TCRs (tcr2.tsv), TCRdist_append needs a result for tcr2 = None")
+        tcr_old = pd.read_csv(output_file_tcr1, sep='\t', keep_default_na=False)
+    else:
+        if 'tcr2' in store:
+            raise ValueError("store holds a result for two sets of TCRs (tcr2), TCRdist_append needs a result for tcr2 = None")
+        tcr_old = store['tcr1']
+    n_old = len(tcr_old)
+    if 'tcr_index' in tcr_old.columns and not np.array_equal(tcr_old['tcr_index'].to_numpy(), np.arange(n_old)):
+        raise ValueError("tcr_index of the stored TCRs has to be 0 ... n - 1 (in order)")
+    n_new = len(tcr_new)
+    batch_args = dict(submat = submat, params_df = params_df, tcrdist_cutoff = tcrdist_cutoff, chunk_size = chunk_size,
+                      chunk_size_col = chunk_size_col, print_chunk_size = print_chunk_size, print_res = print_res,
+                      only_lower_tri = only_lower_tri, kernel = kernel, prune = prune, cache_dir = cache_dir, dedup = dedup,
+                      n_workers = n_workers, backend = backend, stats = stats)
+    stats.set_info(n_old = n_old, n_new = n_new)
+    edge_list = []
+    search = {}
+    if n_old > 0 and n_new > 0:
+        ### new-vs-old: node1 is the new TCR (> every old index), node2 the old TCR
+        print(f"New vs. existing TCRs ({n_new} x {n_old})")
+        stats.set_phase("new_vs_old")
+        res = TCRdist_batch(tcr_new, tcr2 = tcr_old.drop(columns = 'tcr_index', errors = 'ignore'), **batch_args)
+        edges = res['TCRdist_df']
+        node1 = edges['node1_0index'].to_numpy().astype(np.int64) + n_old
+        node2 = edges['node2_0index'].to_numpy().astype(np.int64) - n_new
+        dist = edges['TCRdist'].to_numpy()
+        edge_list.append((node1, node2, dist))
+        if not only_lower_tri:
+            edge_list.append((node2, node1, dist))
+        search = edges.attrs.get('TCRdist_search', {})
+    if n_new > 1: ### a single new TCR has no pairs among the new TCRs
+        print(f"New vs. new TCRs ({n_new} x {n_new})")
+        stats.set_phase("new_vs_new")
+        res = TCRdist_batch(tcr_new, **batch_args)
+        edges = res['TCRdist_df']
+        edge_list.append((edges['node1_0index'].to_numpy().astype(np.int64) + n_old,
+                          edges['node2_0index'].to_numpy().astype(np.int64) + n_old, edges['TCRdist'].to_numpy()))
+        for key, value in edges.attrs.get('TCRdist_search', {}).items():
+            if key != 'fraction_pruned':
+                search[key] = search.get(key, 0) + value
+    node1 = np.concatenate([e[0] for e in edge_list]) if len(edge_list) > 0 else np.zeros(0, dtype = np.int64)
+    node2 = np.concatenate([e[1] for e in edge_list]) if len(edge_list) > 0 else np.zeros(0, dtype = np.int64)
+    dist = np.concatenate([e[2] for e in edge_list]) if len(edge_list) > 0 else np.zeros(0, dtype = np.int32)
+    order = np.lexsort((node2, node1))
+    new_edges = pd.DataFrame({'node1_0index': node1[order].astype(np.int32), 'node2_0index': node2[order].astype(np.int32),
+                              'TCRdist': dist[order].astype(np.int32)})
+    tcr_new = tcr_new.copy()
+    tcr_new['tcr_index'] = range(n_old, n_old + n_new)
+    tcr1 = pd.concat([tcr_old, tcr_new], ignore_index = True)
+    if folder is not None:
+        with stats.stage("write"):
+            if output_format == "tsv":
+                new_edges.to_csv(output_file_edges, sep='\t', mode='a', header=not os.path.exists(output_file_edges), index=False)
+            else:
+                index_dtype = np.int32 if n_old + n_new < np.iinfo(np.int32).max else np.int64
+                tmp_file = output_file_edges + '.tmp'
+                with utils.ChunkWriter(tmp_file, {'node1_0index': index_dtype, 'node2_0index': index_dtype, 'TCRdist': np.int16}, output_format) as writer:
+                    if os.path.exists(output_file_edges):
+                        for chunk in utils.read_chunks(output_file_edges, output_format):
+                            writer.write(chunk)
+                    writer.write(new_edges)
+                os.replace(tmp_file, output_file_edges)
+            tcr1.to_csv(output_file_tcr1, sep='\t', header=True, index=False)
+        print(f"Appended {new_edges.shape[0]} edges to {output_file_edges}")
+    if 'n_pairs' in search and search['n_pairs'] > 0:
+        search['fraction_pruned'] = 1 - search['n_scored'] / search['n_pairs']
+    if len(search) > 0:
+        stats.set_info(TCRdist_search = search)
+    stats.set_info(new_edges = new_edges.shape[0])
+    out = None
+    if return_data:
+        if folder is not None:
+            ### the file now holds the old and the new edges
+            res = pd.concat(list(utils.read_chunks(output_file_edges, output_format)), ignore_index = True).astype(np.int32)
+        else:
+            res = pd.concat([store['TCRdist_df'].astype(np.int32), new_edges], ignore_index = True)
+        if len(search) > 0:
+            res.attrs['TCRdist_search'] = search
+        out = {'TCRdist_df': res, 'tcr1': tcr1, 'stats': stats.close()}
+    else:
+        stats.close()
+    if print_res:
+        print(f"Added {n_new} TCRs to {n_old} existing TCRs: {new_edges.shape[0]} new edges")
+    print(f"Total time taken: {time.time() - start_time:.6f} seconds")
+    return(out)
+
+### Pruned TCRdist for a chunk of query TCRs against a chunk of reference TCRs (numpy arrays). The lower bound (see
+### TCRdist_bound_encoding) is built as a (reference x query) matrix: the table columns of the query codes are taken
+### once per position and their rows gathered by reference code, so the cost does not depend on the size of the table.
+### Returns (query row, reference row, TCRdist) of all pairs with TCRdist <= tcrdist_cutoff, and adds counts to stats.
+def TCRdist_query_tile(query, query_bound, ref, ref_bound, submat, bound_table, tcrdist_cutoff = 90, stats = None):
+    with utils.stage_timer("bound"):
+        bound = np.zeros((ref.shape[0], query.shape[0]), dtype = np.int16)
+        for p in range(query_bound.shape[1]):
+            bound += bound_table[:, query_bound[:, p]][ref_bound[:, p]]
+        cols, rows = np.divmod(np.flatnonzero(bound <= tcrdist_cutoff), query.shape[0])
+    with utils.stage_timer("gather"):
+        dist = submat[query[rows], ref[cols]].sum(axis = 1, dtype = np.int32)
+    keep = dist <= tcrdist_cutoff
+    if stats is not None:
+        stats['n_pairs'] += bound.size
+        stats['n_pruned'] += bound.size - rows.shape[0]
+        stats['n_scored'] += rows.shape[0]
+    return(rows[keep], cols[keep], dist[keep])
+
+### Persistent TCR neighbor index ------------------------------------------------------------------------------
+### TCRdistIndex holds an encoded reference repertoire so new TCRs can be queried against it without re-encoding
+### or re-scanning the whole reference:
+###  - reference TCRs are partitioned by V-gene pair (va, vb) and sorted by CDR3 gap counts (length) within each partition
+###  - query TCRs are sorted by V-gene pair and taken chunk_size at a time; a partition is only scanned if
+###    submat[va] + submat[vb] alone does not exceed the cutoff for some V-gene pair of the chunk, and the reference
+###    TCRs of the remaining partitions go through the pruned kernel (TCRdist_query_tile) chunk_size_col at a time
+###  - save() writes the arrays as .npy files (plus the reference and params tables as .tsv); load() memory-maps them
+### query() returns the same schema as TCRdist_batch(tcr1 = query, tcr2 = reference), with edges sorted by node1, node2,
+### and its utils.PipelineStats summary as 'stats' (JSON lines appended to stats_file, callback called with each event).
+class TCRdistIndex:
+    def __init__(self, encoded, bound, order, partitions, residues, submat, params_df, reference):
+        self.encoded = encoded          # encoded reference TCRs (process_TCRs), in partition order
+        self.bound = bound              # TCRdist_bound_columns of encoded
+        self.order = order              # reference index of each row of encoded
+        self.partitions = partitions    # one row per V-gene pair: va, vb, start, end (rows of encoded)
+        self.residues = residues        # codes in the reference CDR3s (for the gap cost of the bound)
+        self.submat = np.asarray(submat, dtype = np.uint8)
+        self.params_df = params_df
+        self.params_vec = dict(zip(params_df["feature"], params_df["value"]))
+        self.reference = reference
+
+    @classmethod
+    def build(cls, tcrs, submat, params_df, cache_dir = None):
+        submat = to_numpy(submat).astype(np.uint8)
+        params_vec = dict(zip(params_df["feature"], params_df["value"]))
+        encoded = to_numpy(process_TCRs(tcrs, params_vec = params_vec, cache_dir = cache_dir))
+        gap_code = params_vec.get('_')
+        bound = TCRdist_bound_columns(encoded, submat.shape[0], gap_code = gap_code)
+        cdr3_cols = cdr3_columns(encoded.shape[1])
+        va = encoded[:, 0]
+        vb = encoded[:, 1 + len(cdr3_cols[0])]
+        gaps_a = (encoded[:, cdr3_cols[0]] == gap_code).sum(axis = 1)
+        gaps_b = (encoded[:, cdr3_cols[1]] == gap_code).sum(axis = 1)
+        order = np.lexsort((gaps_b, gaps_a, vb, va))
+        keys = np.column_stack([va[order], vb[order]]).astype(np.int64)
+        new_key = np.ones(keys.shape[0], dtype = bool)
+        new_key[1:] = (keys[1:] != keys[:-1]).any(axis = 1)
+        start = np.nonzero(new_key)[0]
+        end = np.append(start[1:], keys.shape[0])
+        partitions = np.column_stack([keys[start], start, end]) if keys.shape[0] > 0 else np.zeros((0, 4), dtype = np.int64)
+        reference = tcrs.copy().reset_index(drop = True)
+        return(cls(encoded[order], bound[order], order, partitions, cdr3_residues(encoded), submat, params_df, reference))
+
+    def __len__(self):
+        return(self.encoded.shape[0])
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok = True)
+        for name in ["encoded", "bound", "order", "partitions", "residues", "submat"]:
+            np.save(os.path.join(folder, name + '.npy'), np.asarray(getattr(self, name)))
+        self.params_df.to_csv(os.path.join(folder, 'params.tsv'), sep = '\t', index = False)
+        self.reference.to_csv(os.path.join(folder, 'reference.tsv'), sep = '\t', index = False)
+
+    @classmethod
+    def load(cls, folder, mmap = True):
+        arrays = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode = 'r' if mmap and name in ["encoded", "bound", "order"] else None)
+                  for name in ["encoded", "bound", "order", "partitions", "residues", "submat"]}
+        params_df = pd.read_csv(os.path.join(folder, 'params.tsv'), sep = '\t', keep_default_na = False)
+        reference = pd.read_csv(os.path.join(folder, 'reference.tsv'), sep = '\t', keep_default_na = False)
+        return(cls(arrays["encoded"], arrays["bound"], arrays["order"], arrays["partitions"], arrays["residues"],
+                   arrays["submat"], params_df, reference))
+
+    ### edges between the query TCRs and the reference with TCRdist <= tcrdist_cutoff
+    def query(self, tcrs, tcrdist_cutoff = 90, chunk_size = 128, chunk_size_col = 1000, n_workers = 1, cache_dir = None, print_res = True,
+              stats_file = None, callback = None):
+        start_time = time.time()
+        stats = utils.PipelineStats("TCRdist_query", log_file = stats_file, callback = callback, backend = np)
+        stats.set_phase("query")
+        with stats.stage("encode"):
+            query = to_numpy(process_TCRs(tcrs, params_vec = self.params_vec, cache_dir = cache_dir))
+        gap_code = self.params_vec.get('_')
+        with stats.stage("bound"):
+            gap_cost = 0 if gap_code is None else TCRdist_gap_cost(self.submat, gap_code, np.union1d(self.residues, cdr3_residues(query)))
+            n_cdr3 = len(cdr3_columns(query.shape[1])[0])
+            bound_table = TCRdist_bound_table(self.submat, gap_cost, n_cdr3)
+            query_bound = TCRdist_bound_columns(query, self.submat.shape[0], gap_code = gap_code)
+        query_keys = query[:, [0, 1 + n_cdr3]]
+        query_order = np.lexsort((query_keys[:, 1], query_keys[:, 0]))
+        part_va = self.partitions[:, 0]
+        part_vb = self.partitions[:, 1]
+        search = {'n_pairs': 0, 'n_pruned': 0, 'n_scored': 0}
+        ### viable partitions of each query chunk, so the number of tiles is known for the progress
+        chunks = []
+        with stats.stage("bound"):
+            for r0 in range(0, query_order.shape[0], chunk_size):
+                rows = query_order[r0:(r0 + chunk_size)]
+                keys = np.unique(query_keys[rows], axis = 0)
+                v_bound = (self.submat[keys[:, 0]][:, part_va].astype(np.int32) + self.submat[keys[:, 1]][:, part_vb]).min(axis = 0)
+                viable = np.nonzero(v_bound <= tcrdist_cutoff)[0]
+                if viable.shape[0] > 0:
+                    chunks.append((rows, viable))
+        n_chunks = sum(-(-int((self.partitions[viable, 3] - self.partitions[viable, 2]).sum()) // chunk_size_col) for rows, viable in chunks)
+        def tasks():
+            for rows, viable in chunks:
+                size = self.partitions[viable, 3] - self.partitions[viable, 2]
+                ref_rows = np.repeat(self.partitions[viable, 2] - (np.cumsum(size) - size), size) + np.arange(size.sum())
+                for c0 in range(0, ref_rows.shape[0], chunk_size_col):
+                    yield(rows, ref_rows[c0:(c0 + chunk_size_col)])
+        def tile_fn(task):
+            rows, ref_rows = task
+            tile_search = {'n_pairs': 0, 'n_pruned': 0, 'n_scored': 0}
+            i, j, dist = TCRdist_query_tile(query[rows], query_bound[rows], self.encoded[ref_rows], self.bound[ref_rows],
+                                            self.submat, bound_table, tcrdist_cutoff = tcrdist_cutoff, stats = tile_search)
+            return(rows[i], np.asarray(self.order[ref_rows[j]]), dist, tile_search)
+        results = []
+        for i, (node1, node2, dist, tile_search) in enumerate(run_tiles(tile_fn, tasks(), n_workers = n_workers, stats = stats)):
+            results.append((node1, node2, dist))
+            for key in tile_search:
+                search[key] += tile_search[key]
+            stats.chunk(i, n_chunks, pairs_evaluated = tile_search['n_pairs'], pairs_scored = tile_search['n_scored'], edges = dist.shape[0])
+        n_query = query.shape[0]
+        with stats.stage("assemble"):
+            node1 = np.concatenate([r[0] for r in results]) if len(results) > 0 else np.zeros(0, dtype = np.int64)
+            node2 = np.concatenate([r[1] for r in results]) if len(results) > 0 else np.zeros(0, dtype = np.int64)
+            dist = np.concatenate([r[2] for r in results]) if len(results) > 0 else np.zeros(0, dtype = np.int32)
+            order = np.lexsort((node2, node1))
+            res = pd.DataFrame({'node1_0index': node1[order].astype(np.int32),
+                                'node2_0index': (node2[order] + n_query).astype(np.int32),
+                                'TCRdist': dist[order].astype(np.int32)})
+        n_total = n_query * len(self)
+        search['fraction_skipped_partitions'] = 1 - search['n_pairs'] / n_total if n_total > 0 else 0.0
+        res.attrs['TCRdist_search'] = search
+        stats.set_info(n_query = n_query, n_reference = len(self), TCRdist_search = search)
+        tcr1 = tcrs.copy()
+        tcr1['tcr_index'] = range(n_query)
+        tcr2 = self.reference.copy()
+        tcr2['tcr_index'] = range(n_query, n_query + len(self))
+        if print_res:
+            print(f"Queried {n_query} TCRs against {len(self)} reference TCRs: {res.shape[0]} edges")
+            print(f"Fraction of pairs skipped by V-gene partition: {search['fraction_skipped_partitions']:.4f}, scored: {search['n_scored']}")
+            print(f"Total time taken: {time.time() - start_time:.6f} seconds")
+        return({'TCRdist_df': res, 'tcr1': tcr1, 'tcr2': tcr2, 'stats': stats.close()})
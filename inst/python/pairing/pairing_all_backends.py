@@ -4,44 +4,120 @@ import pandas as pd
 from datetime import datetime
 import sys
 import os
-## Note: either cupy, mlx.core, or numpy is loaded as "mx"
-
-### if backend is specified, load it
-# if backend == "cupy":
-#   import cupy as mx
-# elif backend == "mlx":
-#   import mlx.core as mx
-# elif backend == "numpy":
-#   import numpy as mx
-# else: ### if backend is not specified, check and load correct one
-
-
-gpu = utils.check_gpu()
-module = utils.check_cupy_or_mlx()
-
-if gpu == "nvidia" and module == "cupy":
-    print("Loading cupy")
-    import cupy as mx #cuda python backend, connect to T4 runtime or other with GPU
-elif gpu == "apple" and module == "mlx":
-    print("Loading mlx")
-    import mlx.core as mx #use this for apple silicon
-else:
-    print("Loading numpy")
-    import numpy as mx #use this for CPU only
-
-def pairing(prefix, folder_out, bigmas, bigmbs, mdh, backend="auto", filter_before_top3 = False, read_files = False, write_files = True, chunk_size = 500) :
-  if read_files:
-    print("start load:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    bigmas = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_bigmas.tsv'), delimiter='\t', dtype=np.float32))
-    bigmbs = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_bigmbs.tsv'), delimiter='\t', dtype=np.float32))
-    mdh = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_mdh.tsv'), delimiter='\t', dtype=np.int32))
-  else:
-    bigmas = mx.array(bigmas)
-    bigmbs = mx.array(bigmbs)
+import scipy.sparse
+import scipy.special
+import functools
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+## Note: either cupy, mlx.core, or numpy is used as "mx"
+## The backend is resolved per call (pairing(backend = ...)) by use_backend, so importing this module does not probe
+## for a GPU. Until then (and in worker processes) mx is numpy.
+mx = np
+
+def use_backend(backend = "auto"):
+    global mx
+    mx = utils.load_backend(backend)
+    return(mx)
+
+### Input well-count matrices (clones x wells) --------------------------------------------------------------
+### bigmas/bigmbs may be dense arrays, scipy sparse matrices (e.g. CSR passed from R) or memory-mapped .npy files.
+### Sparse and memory-mapped matrices stay on the host and are only densified one chunk at a time.
+
+### Load "<prefix>_<name>" from folder_out, trying (in order) a directory of memory-mapped CSR components
+### ("<prefix>_<name>_csr/" with data.npy, indices.npy, indptr.npy and shape.npy), a scipy sparse .npz file,
+### a dense .npy file (memory-mapped), and finally the tab-separated .tsv file.
+def load_well_matrix(folder_out, prefix, name):
+    base = os.path.join(folder_out, prefix + '_' + name)
+    if os.path.isdir(base + '_csr'):
+        data, indices, indptr, shape = [np.load(os.path.join(base + '_csr', x + '.npy'), mmap_mode = 'r') for x in ['data', 'indices', 'indptr', 'shape']]
+        return(scipy.sparse.csr_matrix((data, indices, indptr), shape = tuple(int(x) for x in shape)))
+    if os.path.exists(base + '.npz'):
+        return(scipy.sparse.load_npz(base + '.npz').tocsr())
+    if os.path.exists(base + '.npy'):
+        return(np.load(base + '.npy', mmap_mode = 'r'))
+    return(np.loadtxt(base + '.tsv', delimiter='\t', dtype=np.float32))
+
+def load_mdh(folder_out, prefix):
+    base = os.path.join(folder_out, prefix + '_mdh')
+    if os.path.exists(base + '.npy'):
+        return(np.load(base + '.npy'))
+    return(np.loadtxt(base + '.tsv', delimiter='\t', dtype=np.int32))
+
+### Save a (clones x wells) matrix as CSR components that load_well_matrix can memory-map
+def save_well_matrix(folder_out, prefix, name, mat):
+    mat = scipy.sparse.csr_matrix(mat, dtype = np.float32)
+    folder = os.path.join(folder_out, prefix + '_' + name + '_csr')
+    os.makedirs(folder, exist_ok = True)
+    for x, arr in [('data', mat.data), ('indices', mat.indices), ('indptr', mat.indptr), ('shape', np.array(mat.shape, dtype = np.int64))]:
+        np.save(os.path.join(folder, x + '.npy'), arr)
+
+### matrices that stay on the host and are densified chunk by chunk
+def is_host_matrix(x):
+    return(scipy.sparse.issparse(x) or isinstance(x, np.memmap))
+
+def as_input_matrix(x):
+    if scipy.sparse.issparse(x):
+        return(x.tocsr())
+    if isinstance(x, np.memmap):
+        return(x)
+    return(mx.array(x))
+
+### number of wells each clone (row) is observed in, as a numpy array
+def well_counts(mat, block_size = 65536):
+    if scipy.sparse.issparse(mat):
+        return(np.asarray((mat > 0).sum(axis=1)).ravel().astype(np.int64))
+    if isinstance(mat, np.memmap):
+        counts = [np.sum(mat[i:i + block_size] > 0, axis=1) for i in range(0, mat.shape[0], block_size)]
+        return(np.concatenate(counts) if len(counts) > 0 else np.zeros(0, dtype = np.int64))
+    return(to_numpy(mx.sum(mat > 0, axis=1)))
+
+### rows (a slice or an array of indices) of a well-count matrix as a dense float32 backend array
+def dense_rows(mat, rows):
+    if scipy.sparse.issparse(mat):
+        return(mx.array(mat[rows].toarray().astype(np.float32)))
+    if isinstance(mat, np.memmap):
+        return(mx.array(np.asarray(mat[rows], dtype = np.float32)))
+    if isinstance(rows, slice):
+        return(mat[rows])
+    return(mat[mx.array(rows)])
+
+### well occupancy as a dense (wells x clones) float32 backend array
+def occupancy_t(mat):
+    if is_host_matrix(mat):
+        return(mx.array(occupancy_csr(mat).T.toarray()))
+    return((mat > 0).T.astype(mx.float32))
+
+### Returns a dict with the MAD-HYPE ("mdh") and T-SHELL ("corr") results and "stats", the summary of a
+### utils.PipelineStats (stage times, counts, memory, and a data frame with one row per chunk).
+### stats_file appends the chunk/progress/summary events as JSON lines; callback(event) is called for every event.
+### fused = True computes the shared-well matmul once per chunk for both algorithms (fused_process). It is meant for
+### GPU backends: MAD-HYPE then runs dense and without pruning, so on numpy (CPU) the default sparse + pruned path is
+### faster (384-well synthetic plate, 5282 x 4850 chains: 1.32 s fused vs. 0.95 s default). max_bytes bounds the
+### (chunk x beta tile) temporaries of T-SHELL and of fused mode only; the separate MAD-HYPE step is not tiled (its dense
+### engine holds a full chunk_size x n_beta overlap matrix, so lower chunk_size to bound it).
+def pairing(prefix, folder_out, bigmas, bigmbs, mdh, backend="auto", filter_before_top3 = False, read_files = False, write_files = True, chunk_size = 500, engine = "auto", prune = True, top_k = 3, max_bytes = None, n_workers = 1, fused = False, output_format = "csv", return_data = True, stats_file = None, callback = None) :
+  use_backend(backend)
+  stats = utils.PipelineStats("pairing", log_file = stats_file, callback = callback, backend = mx)
+  stats.set_info(prefix = prefix, fused = fused, chunk_size = int(chunk_size), n_workers = n_workers)
+  with stats.stage("load"):
+    if read_files:
+      print("start load:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+      bigmas = load_well_matrix(folder_out, prefix, 'bigmas')
+      bigmbs = load_well_matrix(folder_out, prefix, 'bigmbs')
+      mdh = load_mdh(folder_out, prefix)
+    bigmas = as_input_matrix(bigmas)
+    bigmbs = as_input_matrix(bigmbs)
     mdh = mx.array(mdh)
-  mdh = madhyper_process(prefix = prefix, folder_out = folder_out, bigmas = bigmas, bigmbs = bigmbs, mdh = mdh, write_files = write_files, chunk_size = chunk_size)
-  corr = correlation_process(prefix = prefix, folder_out = folder_out, bigmas = bigmas, bigmbs = bigmbs, filter_before_top3 = filter_before_top3, write_files = write_files, chunk_size = chunk_size)
-  res = {"mdh": mdh, "corr": corr}
+  stats.set_info(n_alpha = bigmas.shape[0], n_beta = bigmbs.shape[0], n_wells = bigmas.shape[1])
+  if fused:
+    mdh, corr = fused_process(prefix = prefix, folder_out = folder_out, bigmas = bigmas, bigmbs = bigmbs, mdh = mdh, filter_before_top3 = filter_before_top3, write_files = write_files, chunk_size = chunk_size, top_k = top_k, max_bytes = max_bytes, n_workers = n_workers, output_format = output_format, return_data = return_data, stats = stats)
+    return({"mdh": mdh, "corr": corr, "stats": stats.close()})
+  mdh = madhyper_process(prefix = prefix, folder_out = folder_out, bigmas = bigmas, bigmbs = bigmbs, mdh = mdh, write_files = write_files, chunk_size = chunk_size, engine = engine, prune = prune, n_workers = n_workers, output_format = output_format, return_data = return_data, stats = stats)
+  corr = correlation_process(prefix = prefix, folder_out = folder_out, bigmas = bigmas, bigmbs = bigmbs, filter_before_top3 = filter_before_top3, write_files = write_files, chunk_size = chunk_size, top_k = top_k, max_bytes = max_bytes, n_workers = n_workers, output_format = output_format, return_data = return_data, stats = stats)
+  res = {"mdh": mdh, "corr": corr, "stats": stats.close()}
   return(res)
 
 
@@ -59,128 +135,797 @@ def top3_indices(arr):
     result = mx.stack([row_indices, col_indices], axis=1)
     
     return result
+
+### Indices of the top k values per row, in the same layout as top3_indices (ascending within each row).
+### Uses a partial selection (argpartition) instead of sorting every row, then sorts only the k selected values.
+def topk_indices(arr, k = 3):
+    n_cols = arr.shape[1]
+    k = min(int(k), n_cols)
+    topk = mx.argpartition(arr, n_cols - k, axis=1)[:, -k:]  # shape: (500, k), unordered
+    order = mx.argsort(mx.take_along_axis(arr, topk, axis=1), axis=1)
+    topk = mx.take_along_axis(topk, order, axis=1)
+
+    row_indices = mx.repeat(mx.arange(arr.shape[0]), k)  # shape: (500*k,)
+    col_indices = topk.flatten()  # shape: (500*k,)
+    result = mx.stack([row_indices, col_indices], axis=1)
+
+    return result
   
 def to_numpy(x):
   if hasattr(x, 'get'):  # CuPy
       return(x.get())
-  return(np.array(x))  # NumPy or MLX
+  if isinstance(x, np.ndarray):  # NumPy, already on the host
+      return(x)
+  return(np.array(x))  # MLX
+
+### Choose how shared wells are counted in madhyper_process:
+### "dense" uses a float32 matmul on the backend (mx), "sparse" uses CSR occupancy matrices on the CPU.
+### "auto" picks "sparse" when running on numpy and "dense" on a GPU backend.
+def resolve_engine(engine = "auto"):
+    if engine == "auto":
+        return("sparse" if mx.__name__ == "numpy" else "dense")
+    if engine not in ["dense", "sparse"]:
+        raise ValueError(f"Unknown engine '{engine}', expected 'auto', 'dense' or 'sparse'")
+    return(engine)
+
+### well occupancy (clone observed in well) as a CSR matrix of 0/1 float32 values (clones x wells)
+def occupancy_csr(mat, block_size = 65536):
+    if scipy.sparse.issparse(mat):
+        occ = scipy.sparse.csr_matrix(mat > 0, dtype = np.float32)
+    elif isinstance(mat, np.memmap): # build from blocks of rows, so the file is never loaded at once
+        blocks = [scipy.sparse.csr_matrix(np.asarray(mat[i:i + block_size]) > 0, dtype = np.float32) for i in range(0, mat.shape[0], block_size)]
+        occ = scipy.sparse.vstack(blocks, format = 'csr') if len(blocks) > 0 else scipy.sparse.csr_matrix(mat.shape, dtype = np.float32)
+    else:
+        occ = scipy.sparse.csr_matrix(to_numpy(mat) > 0, dtype = np.float32)
+    occ.sort_indices()
+    return(occ)
+
+### MAD-HYPE pairs for one chunk of alpha chains using sparse occupancy matrices.
+### a_occ: (chunk x wells) CSR, b_occ_t: (wells x n_beta) CSR, a_total/b_total: 1-d well counts.
+### Only pairs sharing at least one well come out of the sparse product; pairs sharing no wells
+### are added back for the (rare) rows where mdh[0, a_total] allows them, so the output matches the dense engine.
+### Returns row indices (within chunk), beta indices and wij, sorted like np.argwhere on the dense mask.
+def madhyper_chunk_sparse(a_occ, b_occ_t, a_total, b_total, mdh):
+    with utils.stage_timer("matmul"):
+        overlaps = (a_occ @ b_occ_t).tocsr()
+    with utils.stage_timer("threshold"):
+        return(madhyper_pairs_sparse(overlaps, a_total, b_total, mdh))
+
+### pairs of madhyper_chunk_sparse from the (chunk x n_beta) CSR matrix of shared wells
+def madhyper_pairs_sparse(overlaps, a_total, b_total, mdh):
+    rows = np.repeat(np.arange(overlaps.shape[0], dtype = np.int64), np.diff(overlaps.indptr))
+    cols = overlaps.indices.astype(np.int64)
+    wij = overlaps.data
+    wij_int = wij.astype(np.int64)
+    keep = (b_total[cols] - wij_int) < mdh[wij_int, a_total[rows] - wij_int]
+    rows, cols, wij = rows[keep], cols[keep], wij[keep]
+    thres_zero = mdh[0, a_total]
+    zero_rows = np.nonzero(thres_zero > b_total.min())[0] if b_total.shape[0] > 0 else []
+    if len(zero_rows) > 0:
+        extra_rows = [rows]
+        extra_cols = [cols]
+        extra_wij = [wij]
+        for r in zero_rows:
+            cand = np.nonzero(b_total < thres_zero[r])[0]
+            shared = overlaps.indices[overlaps.indptr[r]:overlaps.indptr[r+1]]
+            cand = np.setdiff1d(cand, shared, assume_unique = True)
+            extra_rows.append(np.full(cand.shape[0], r, dtype = np.int64))
+            extra_cols.append(cand.astype(np.int64))
+            extra_wij.append(np.zeros(cand.shape[0], dtype = wij.dtype))
+        rows = np.concatenate(extra_rows)
+        cols = np.concatenate(extra_cols)
+        wij = np.concatenate(extra_wij)
+    order = np.lexsort((cols, rows))
+    return(rows[order], cols[order], wij[order])
+
+### Pre-computed pruning index for MAD-HYPE.
+### A pair with wa = a_total and wb = b_total can only pass if some overlap wij in [0, min(wa, wb)]
+### gives wb - wij < mdh[wij, wa - wij]. This table of viable (wa, wb) combinations is derived from mdh once,
+### and beta clones are bucketed by b_total so that impossible buckets are skipped for every alpha chunk.
+def build_prune_index(b_total, mdh):
+    mdh = to_numpy(mdh)
+    n = mdh.shape[0]
+    viable = np.zeros((n, n), dtype = bool) # rows: a_total, columns: b_total
+    w_all = np.arange(n)
+    for wij in range(n):
+        wa = w_all[wij:]
+        wb = w_all[wij:]
+        viable[wij:, wij:] |= (wb[None, :] - wij) < mdh[wij, wa - wij][:, None]
+    order = np.argsort(b_total, kind = "stable")
+    values, bucket_start, bucket_size = np.unique(b_total[order], return_index = True, return_counts = True)
+    index = {
+        'viable': viable,
+        'order': order,
+        'values': values,
+        'bucket_start': bucket_start,
+        'bucket_end': bucket_start + bucket_size,
+        'bucket_size': bucket_size
+    }
+    return(index)
+
+### beta indices (in bucket order) that can pair with at least one alpha chain with these a_total values,
+### plus the number of viable (alpha, beta) combinations for the chunk
+def prune_candidates(index, a_total):
+    viable_rows = index['viable'][:, index['values']][a_total]
+    keep = np.nonzero(viable_rows.any(axis = 0))[0]
+    n_viable = int((viable_rows @ index['bucket_size']).sum())
+    if keep.shape[0] == 0:
+        return(np.zeros(0, dtype = np.int64), n_viable)
+    cols = np.concatenate([index['order'][index['bucket_start'][k]:index['bucket_end'][k]] for k in keep])
+    return(cols, n_viable)
+
+### MAD-HYPE pairs for one chunk of alpha chains on the backend (mx), using a dense float32 matmul.
+### Returns row indices (within chunk), beta indices (columns of b_occ_t) and wij as numpy arrays.
+def madhyper_chunk_dense(a_rows, b_occ_t, a_total, b_total, mdh):
+    with utils.stage_timer("matmul"):
+        overlaps = mx.matmul((a_rows > 0).astype(mx.float32), b_occ_t) #optimized
+    return(madhyper_pairs_from_overlaps(overlaps, a_total, b_total, mdh))
+
+### indices of the True entries of a (chunk x n_beta) mask as a numpy (n, 2) array.
+### On cupy only the indices cross to the host; on mlx the mask is only copied if it has any True entry.
+def argwhere_mask(mask):
+    if mx.__name__ == "cupy":
+        return(to_numpy(mx.argwhere(mask)))
+    if mx.__name__ != "numpy" and not bool(mx.any(mask)):
+        return(np.zeros((0, 2), dtype = np.int64))
+    return(np.argwhere(to_numpy(mask)))
+
+### MAD-HYPE pairs from a (chunk x n_beta) matrix of shared wells computed on the backend
+def madhyper_pairs_from_overlaps(overlaps, a_total, b_total, mdh):
+    with utils.stage_timer("threshold"):
+        mask_condition=-(overlaps.T - b_total).T < mdh[(overlaps).astype(mx.int16), -(overlaps - a_total).astype(mx.int16)]# mad hype only
+    with utils.stage_timer("transfer"):
+        pairs = argwhere_mask(mask_condition)
+        rows = pairs[:, 0]
+        cols = pairs[:, 1]
+        if rows.shape[0] == 0:
+            return(rows, cols, np.zeros(0, dtype = np.float32))
+        wij = to_numpy(overlaps[mx.array(rows), mx.array(cols)])
+    return(rows, cols, wij)
+
+### Multi-process executor for pairing chunks (numpy backend only) ---------------------------------------
+### The beta-side arrays ("shared", a dict of numpy arrays or CSR matrices) are copied into shared memory once,
+### each worker process attaches to them at start-up, and only the alpha chunk of each task is sent to the workers.
+### Results come back in chunk order, so the output is identical to the serial run.
+
+_worker_shared = {}
+_worker_blocks = []
+
+def _put_shared(arr, blocks):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+    blocks.append(shm)
+    np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)[...] = arr
+    return((shm.name, arr.shape, arr.dtype.str))
+
+def _get_shared(desc):
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name = name)
+    _worker_blocks.append(shm)
+    return(np.ndarray(shape, dtype = np.dtype(dtype), buffer = shm.buf))
+
+def share_arrays(shared, blocks):
+    descriptors = {}
+    for name, arr in shared.items():
+        if arr is None:
+            continue
+        if scipy.sparse.issparse(arr):
+            arr = arr.tocsr()
+            descriptors[name] = ('csr', arr.shape, [_put_shared(x, blocks) for x in (arr.data, arr.indices, arr.indptr)])
+        else:
+            descriptors[name] = ('array', None, _put_shared(to_numpy(arr), blocks))
+    return(descriptors)
+
+def _init_worker(descriptors):
+    global mx
+    import numpy as mx # workers always run on the CPU
+    for name, (kind, shape, desc) in descriptors.items():
+        if kind == 'csr':
+            _worker_shared[name] = scipy.sparse.csr_matrix(tuple(_get_shared(x) for x in desc), shape = shape)
+        else:
+            _worker_shared[name] = _get_shared(desc)
+
+def _run_worker_task(chunk_fn, task):
+    return(chunk_fn(task, _worker_shared))
+
+### as _run_worker_task, also returning the stage times of the task (utils.stage_timer)
+def _run_worker_task_timed(chunk_fn, task):
+    return(utils.collect_stage_times(chunk_fn, task, _worker_shared))
+
+### Run chunk_fn(task, shared) for every task and yield the results in task order.
+### With n_workers > 1 the tasks are spread over a pool of processes (at most 2 tasks queued per worker).
+### With stats (utils.PipelineStats), the stage times of every task are added to it, also from the worker processes.
+def run_chunks(chunk_fn, tasks, shared, n_workers = 1, stats = None):
+    n_workers = 1 if n_workers is None else int(n_workers)
+    if n_workers > 1 and mx.__name__ != "numpy":
+        print(f"n_workers is only used with the numpy backend, running serially on {mx.__name__}")
+        n_workers = 1
+    if n_workers <= 1:
+        for task in tasks:
+            yield chunk_fn(task, shared) if stats is None else stats.run_chunk(chunk_fn, task, shared)
+        return
+    worker_fn = _run_worker_task if stats is None else _run_worker_task_timed
+    def result(future):
+        if stats is None:
+            return(future.result())
+        res, times = future.result()
+        stats.add_times(times)
+        return(res)
+    blocks = []
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    added_path = module_dir not in sys.path
+    if added_path: # worker processes need to import this module and its utils
+        sys.path.insert(0, module_dir)
+    try:
+        descriptors = share_arrays(shared, blocks)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = ctx, initializer = _init_worker, initargs = (descriptors,)) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(worker_fn, chunk_fn, task))
+                if len(pending) >= 2 * n_workers:
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        if added_path and module_dir in sys.path:
+            sys.path.remove(module_dir)
+
+### Result tables ----------------------------------------------------------------------------------------------
+### Column dtypes used for the Parquet/Arrow output (well counts fit in int16, chain indices in int32)
+MADHYPE_DTYPES = {'alpha_nuc': np.int32, 'beta_nuc': np.int32, 'wij': np.int16, 'wa': np.int16, 'wb': np.int16}
+TSHELL_DTYPES = {'alpha_nuc': np.int32, 'beta_nuc': np.int32, 'r': np.float32, 'wij': np.int16, 'wa': np.int16, 'wb': np.int16}
+
+### With output_format "parquet" or "arrow", results are streamed to disk chunk by chunk as they are produced.
+### Returns None if nothing is streamed (write_files off, or csv, which is written at the end from the data frame).
+def open_result_writer(folder_out, prefix, suffix, dtypes, write_files, output_format = "csv"):
+    if output_format not in ["csv", "parquet", "arrow"]:
+        raise ValueError(f"Unknown output_format '{output_format}', expected 'csv', 'parquet' or 'arrow'")
+    if not write_files or output_format == "csv":
+        return(None)
+    return(utils.ChunkWriter(os.path.join(folder_out, prefix + suffix + utils.output_extension(output_format)), dtypes, output_format))
+
+### Close the streaming writer (if any) and return the collected chunks as one data frame.
+### Chunks are only kept if return_data is set or the output is not streamed; otherwise returns None.
+def finish_results(results, writer, columns, return_data = True):
+    if writer is not None:
+        writer.close()
+        print(f"Wrote {writer.n_rows} rows to {writer.path}")
+        if not return_data:
+            return(None)
+    return(utils.chunks_to_df(results, columns))
 
-def madhyper_process(prefix, folder_out, bigmas, bigmbs, mdh, write_files = False, chunk_size = 500):
+### MAD-HYPE pairs for one task: (alpha_idx, a_chunk, a_total, beta_idx), see madhyper_process.
+### A CSR a_chunk selects the sparse engine, a dense one the dense engine.
+### Returns alpha_idx, a_total and the (row within chunk, beta index, wij) of every pair.
+def madhyper_task(task, shared):
+    alpha_idx, a_chunk, a_total, beta_idx = task
+    if beta_idx is not None and beta_idx.shape[0] == 0:
+        rows = cols = np.zeros(0, dtype = np.int64)
+        wij = np.zeros(0, dtype = np.float32)
+    elif scipy.sparse.issparse(a_chunk):
+        b_chunk = shared['b_occ_t'] if beta_idx is None else shared['b_occ'][beta_idx].T.tocsr()
+        b_total = shared['b_total'] if beta_idx is None else shared['b_total'][beta_idx]
+        rows, cols, wij = madhyper_chunk_sparse(a_chunk, b_chunk, a_total, b_total, shared['mdh'])
+    else:
+        b_chunk = shared['b_occ_t'] if beta_idx is None else shared['b_occ_t'][:, mx.array(beta_idx)]
+        b_total_chunk = shared['b_total_mx'] if beta_idx is None else shared['b_total_mx'][mx.array(beta_idx)]
+        a_total_chunk = mx.sum(a_chunk > 0, axis=1,keepdims=True)
+        rows, cols, wij = madhyper_chunk_dense(a_chunk, b_chunk, a_total_chunk, b_total_chunk, shared['mdh'])
+    if beta_idx is not None:
+        cols = beta_idx[cols]
+    return(alpha_idx, a_total, rows, cols, wij)
+
+def madhyper_process(prefix, folder_out, bigmas, bigmbs, mdh, write_files = False, chunk_size = 500, engine = "auto", prune = True, n_workers = 1, output_format = "csv", return_data = True, stats = None):
     #print("start load:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     #bigmas = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_bigmas.tsv'), delimiter='\t', dtype=np.float32))
     #bigmbs = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_bigmbs.tsv'), delimiter='\t', dtype=np.float32))
     #mdh = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_mdh.tsv'), delimiter='\t', dtype=np.int32))
-    rowinds_bigmas=mx.arange(bigmas.shape[0])
-    rowinds_bigmbs=mx.arange(bigmbs.shape[0])
+    engine = resolve_engine(engine)
+    if stats is None:
+        stats = utils.PipelineStats("madhyper", backend = mx)
+    stats.set_phase("madhyper")
     results = []
     #chunk_size =500  # Define your chunk size
     chunk_size = int(chunk_size)
-    n_wells = bigmas.shape[1]  # Assuming n_wells is the number of columns in bigmas
-    print('total number of chunks', bigmas.shape[0]//chunk_size)
-    total_chunks = (bigmas.shape[0] // chunk_size)+1
-    b_total = mx.sum(bigmbs > 0, axis=1,keepdims=True)
-    bigmbs=(bigmbs > 0).T.astype(mx.float32)
+    n_alpha = bigmas.shape[0]
+    n_beta = bigmbs.shape[0]
+    n_chunks = -(-n_alpha // chunk_size)
+    print('total number of chunks', n_chunks)
+    with stats.stage("encode"):
+        if engine == "sparse":
+            a_occ = occupancy_csr(bigmas)
+            b_occ = occupancy_csr(bigmbs)
+            a_total_all = np.diff(a_occ.indptr).astype(np.int64)
+            b_total_all = np.diff(b_occ.indptr).astype(np.int64)
+            shared = {'b_occ': b_occ, 'b_occ_t': b_occ.T.tocsr(), 'b_total': b_total_all, 'mdh': to_numpy(mdh)}
+        else:
+            a_total_all = well_counts(bigmas)
+            b_total_all = well_counts(bigmbs)
+            b_total = mx.array(b_total_all)[:, None]
+            shared = {'b_occ_t': occupancy_t(bigmbs), 'b_total_mx': b_total, 'mdh': mdh}
+        if prune:
+            index = build_prune_index(b_total_all, mdh)
+            alpha_order = np.argsort(a_total_all, kind = "stable") # group alpha chains with similar well counts
+    search = {'n_evaluated': 0, 'n_viable': 0}
+    chunk_evaluated = [] # pairs evaluated in each chunk
+    writer = open_result_writer(folder_out, prefix, '_madhyperesults', MADHYPE_DTYPES, write_files, output_format)
+    def tasks():
+        for ch in range(0, n_alpha, chunk_size):
+            chunk_end = min(ch + chunk_size, n_alpha)
+            with stats.stage("bound"):
+                if prune:
+                    alpha_idx = alpha_order[ch:chunk_end]
+                    a_total = a_total_all[alpha_idx]
+                    beta_idx, n_viable_chunk = prune_candidates(index, a_total)
+                    search['n_viable'] += n_viable_chunk
+                else:
+                    alpha_idx = np.arange(ch, chunk_end)
+                    a_total = a_total_all[ch:chunk_end]
+                    beta_idx = None
+            chunk_evaluated.append(alpha_idx.shape[0] * (n_beta if beta_idx is None else beta_idx.shape[0]))
+            search['n_evaluated'] += chunk_evaluated[-1]
+            with stats.stage("load"):
+                if engine == "sparse":
+                    a_chunk = a_occ[alpha_idx] if prune else a_occ[ch:chunk_end]
+                else:
+                    a_chunk = dense_rows(bigmas, alpha_idx if prune else slice(ch, chunk_end))
+            yield (alpha_idx, a_chunk, a_total, beta_idx)
     print("start time for MAD-HYPE:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    for ch in range(0, bigmas.shape[0], chunk_size):
-        percent_complete = int((ch // chunk_size + 1) / total_chunks * 100)
-        # Print progress only on 5%, 10%, etc.
-        if percent_complete % 10 == 0 and percent_complete > 0:
-            print(f'Progress: {ch} ({percent_complete}%)')
-        chunk_end = min(ch + chunk_size, bigmas.shape[0])
-        row_range = slice(ch, chunk_end)
-        a_total = mx.sum(bigmas[row_range] > 0, axis=1,keepdims=True)
-        overlaps = mx.matmul((bigmas[row_range] > 0).astype(mx.float32), bigmbs) #optimized
-        mask_condition=-(overlaps.T - b_total).T < mdh[(overlaps).astype(mx.int16), -(overlaps - a_total).astype(mx.int16)]# mad hype only
-        pairs = mx.array(np.argwhere(to_numpy(mask_condition)))
-        result = {
-              'alpha_nuc': 1+to_numpy(rowinds_bigmas[row_range][pairs[:, 0]]),
-              'beta_nuc': 1+to_numpy(rowinds_bigmbs[pairs[:, 1]]),
-              'wij': to_numpy(overlaps[pairs[:, 0], pairs[:, 1]]),
-              'wa': to_numpy(a_total[:,0][pairs[:, 0]]),
-              'wb': to_numpy(b_total[:,0][pairs[:, 1]])
-              }
-        results.append(result)
+    for i, (alpha_idx, a_total, rows, cols, wij) in enumerate(run_chunks(madhyper_task, tasks(), shared, n_workers = n_workers, stats = stats)):
+        ch = i * chunk_size
+        with stats.stage("assemble"):
+            result = {
+                  'alpha_nuc': 1+alpha_idx[rows],
+                  'beta_nuc': 1+cols,
+                  'wij': wij,
+                  'wa': a_total[rows],
+                  'wb': b_total_all[cols]
+                  }
+        if writer is not None:
+            with stats.stage("write"):
+                writer.write(result)
+        if return_data or writer is None:
+            results.append(result)
+        percent_complete = stats.chunk(i, n_chunks, pairs_evaluated = chunk_evaluated[i], madhyper_pairs = rows.shape[0])
+        # Print progress only on 10%, 20%, etc.
+        if percent_complete is not None:
+            print(f'Progress: {min(ch + chunk_size, n_alpha)} ({percent_complete}%)')
 #result is a list of dictionaries, each dictionary contains the results for a chunk of rows. You can convert it to a pandas DataFrame like this: 
     print("end time for MAD-HYPE:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 #make pandas dataframe from each element of results and concatenate them
-    results_df = pd.concat([pd.DataFrame(result) for result in results])
+    n_total = n_alpha * n_beta
+    search_stats = {
+        'n_total': n_total,
+        'n_evaluated': search['n_evaluated'],
+        'n_viable': search['n_viable'] if prune else n_total,
+        'fraction_pruned': 1 - search['n_evaluated'] / n_total if n_total > 0 else 0.0
+    }
+    stats.set_info(madhyper_search = search_stats)
+    if prune:
+        print(f"Fraction of search space pruned: {search_stats['fraction_pruned']:.4f}")
+    with stats.stage("assemble"):
+        results_df = finish_results(results, writer, MADHYPE_DTYPES.keys(), return_data = return_data)
+        if results_df is not None and prune: ### restore the (alpha, beta) order of the unpruned search
+            order = np.lexsort((results_df['beta_nuc'].to_numpy(), results_df['alpha_nuc'].to_numpy()))
+            results_df = results_df.iloc[order]
+    if results_df is None:
+        print(f"Number of pairs: {writer.n_rows}")
+        return(None)
     results_df = results_df.reset_index(drop=True)
-    if write_files:
-      results_df.to_csv(os.path.join(folder_out, prefix+'_madhyperesults.csv'), index=False)
+    results_df.attrs['madhyper_search'] = search_stats
+    if write_files and output_format == "csv":
+      with stats.stage("write"):
+        results_df.to_csv(os.path.join(folder_out, prefix+'_madhyperesults.csv'), index=False)
     print(f"Number of pairs: {results_df.shape[0]}")
-    return(results_df)
+    return(results_df if return_data else None)
+
+### Multi-plate pairing ------------------------------------------------------------------------------------------
+### pairing_batch runs several plates (or well subsets) through the fused MAD-HYPE + T-SHELL search at once:
+###  - the beta-side statistics of every plate (fused_beta_stats) are computed once and reused for all its chunks;
+###    plates with identical beta matrices share them, and with a beta_cache dict they are also reused across calls.
+###    Reuse is per whole matrix: only byte-identical beta matrices (same clones, wells and counts) hit the cache, so
+###    overlapping clone sets of different timepoints are recomputed.
+###  - the chunks of all plates go through one scheduler (run_chunks), so the worker pool and the shared memory
+###    are set up once for the whole batch instead of once per plate
+###  - results of each plate are the same as pairing(fused = True) for that plate, tagged with a "plate" column
+### plates is a dict of plate name -> dict with "bigmas", "bigmbs" and either "mdh" or "cpw" (cells per well, used to
+### build the surface with madhyper_surface and the prior of run_pairing, 1 / sqrt(n_alpha * n_beta)).
+
+### key of a well-count matrix for the beta_cache: hash of the backend and of its format, shape, dtype and values
+def matrix_fingerprint(x, min_wells = 2):
+    h = hashlib.sha1(b"fused_beta_stats-v1")
+    h.update(repr((mx.__name__, scipy.sparse.issparse(x), tuple(x.shape), str(x.dtype), int(min_wells))).encode())
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+        for arr in [x.data, x.indices, x.indptr]:
+            h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        h.update(np.ascontiguousarray(to_numpy(x)).tobytes())
+    return(h.hexdigest())
+
+### fused_task for the plate in task = (plate key, fused task); the arrays of each plate are in shared as "<key>/<name>"
+def plate_task(task, shared):
+    key, inner = task
+    start = key + '/'
+    return(fused_task(inner, {name[len(start):]: arr for name, arr in shared.items() if name.startswith(start)}))
+
+def pairing_batch(plates, folder_out = ".", prefix = "batch", backend = "auto", min_wells = 2, filter_before_top3 = False, write_files = False, chunk_size = 500, top_k = 3, max_bytes = None, n_workers = 1, output_format = "csv", return_data = True, beta_cache = None, stats_file = None, callback = None):
+  use_backend(backend)
+  chunk_size = int(chunk_size)
+  names = list(plates.keys())
+  stats = utils.PipelineStats("pairing_batch", log_file = stats_file, callback = callback, backend = mx)
+  stats.set_info(prefix = prefix, n_plates = len(names), chunk_size = chunk_size, n_workers = n_workers)
+  if beta_cache is None:
+    beta_cache = {}
+  shared = {}
+  plate_info = []
+  n_cached = 0
+  for i, name in enumerate(names):
+    plate = plates[name]
+    with stats.stage("load"):
+      bigmas = as_input_matrix(plate['bigmas'])
+      bigmbs = as_input_matrix(plate['bigmbs'])
+    if bigmas.shape[1] != bigmbs.shape[1]:
+      raise ValueError(f"Plate '{name}': bigmas and bigmbs need the same wells (columns), got {bigmas.shape[1]} and {bigmbs.shape[1]}")
+    if plate.get('mdh') is not None:
+      mdh = plate['mdh']
+    elif plate.get('cpw') is not None:
+      mdh = madhyper_surface(bigmas.shape[1], cpw = plate['cpw'], alpha = 2, prior = 1 / (float(bigmas.shape[0]) * float(bigmbs.shape[0])) ** 0.5)
+    else:
+      raise ValueError(f"Plate '{name}' needs either 'mdh' or 'cpw'")
+    with stats.stage("encode"):
+      fingerprint = matrix_fingerprint(bigmbs, min_wells)
+      if fingerprint in beta_cache:
+        n_cached += 1
+      else:
+        beta_cache[fingerprint] = fused_beta_stats(bigmbs, min_wells = min_wells)
+      beta_stats = beta_cache[fingerprint]
+      key = str(i)
+      for field in ['b_occ_t', 'b_total_mx', 'bigmb_w1_scaled', 'b_total_corr', 'corr_cols']:
+        shared[key + '/' + field] = beta_stats[field]
+      shared[key + '/mdh'] = mx.array(mdh)
+      corr_alpha = well_counts(bigmas) > min_wells
+    tile_cols = correlation_tile_cols(max_bytes, chunk_size, beta_stats['b_total_np'].shape[0], filter_before_top3 = filter_before_top3, top_k = top_k)
+    plate_info.append({'bigmas': bigmas, 'stats': beta_stats, 'corr_alpha': corr_alpha, 'tile_cols': tile_cols})
+  print(f"Plates: {len(names)}, beta-side statistics reused for {n_cached}")
+  stats.set_info(beta_stats_reused = n_cached)
+  def tasks():
+    for i, info in enumerate(plate_info):
+      n_alpha = info['bigmas'].shape[0]
+      for ch in range(0, n_alpha, chunk_size):
+        chunk_end = min(ch + chunk_size, n_alpha)
+        valid = info['corr_alpha'][ch:chunk_end]
+        corr_rows = None if valid.all() else np.nonzero(valid)[0]
+        with stats.stage("load"):
+          a_rows = dense_rows(info['bigmas'], slice(ch, chunk_end))
+        yield (str(i), (a_rows, corr_rows, filter_before_top3, top_k, info['tile_cols']))
+  ### plate of every chunk, in the order run_chunks returns them
+  chunk_plates = [(i, ch) for i, info in enumerate(plate_info) for ch in range(0, info['bigmas'].shape[0], chunk_size)]
+  mdh_dtypes = dict(MADHYPE_DTYPES, plate = np.int16)
+  corr_dtypes = dict(TSHELL_DTYPES, plate = np.int16)
+  results_mdh = []
+  results_corr = []
+  writer_mdh = open_result_writer(folder_out, prefix, '_madhyperesults', mdh_dtypes, write_files, output_format)
+  writer_corr = open_result_writer(folder_out, prefix, '_corresults', corr_dtypes, write_files, output_format)
+  print("start time for MAD-HYPE + T-Shell (batch):", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+  for j, (madhyper, corr) in enumerate(run_chunks(plate_task, tasks(), shared, n_workers = n_workers, stats = stats)):
+    i, ch = chunk_plates[j]
+    info = plate_info[i]
+    b_total_np = info['stats']['b_total_np']
+    corr_cols = info['stats']['corr_cols_np']
+    if ch == 0:
+      print(f"Plate {names[i]} ({i + 1} of {len(names)})")
+      ### chunk records of each plate are tagged with its name
+      stats.set_phase(names[i])
+    rows, cols, wij, wa = madhyper
+    with stats.stage("assemble"):
+      result = {
+            'alpha_nuc': 1+ch+rows,
+            'beta_nuc': 1+cols,
+            'wij': wij,
+            'wa': wa,
+            'wb': b_total_np[cols],
+            'plate': np.full(rows.shape[0], i)
+            }
+    if writer_mdh is not None:
+      with stats.stage("write"):
+        writer_mdh.write(result)
+    if return_data or writer_mdh is None:
+      results_mdh.append(result)
+    n_corr = 0
+    if corr is not None:
+      rows_c, cols_c, r, wij_c, wa_c = corr
+      n_corr = rows_c.shape[0]
+      with stats.stage("assemble"):
+        alpha_c = np.arange(ch, ch + info['corr_alpha'][ch:ch + chunk_size].shape[0])[info['corr_alpha'][ch:ch + chunk_size]]
+        result = {
+            'alpha_nuc': 1 + alpha_c[rows_c],
+            'beta_nuc': 1 + corr_cols[cols_c],
+            'r': r,
+            'wij': wij_c,
+            'wa': wa_c,
+            'wb': b_total_np[corr_cols[cols_c]],
+            'plate': np.full(rows_c.shape[0], i)
+        }
+      if writer_corr is not None:
+        with stats.stage("write"):
+          writer_corr.write(result)
+      if return_data or writer_corr is None:
+        results_corr.append(result)
+    percent_complete = stats.chunk(j, len(chunk_plates), pairs_evaluated = min(chunk_size, info['bigmas'].shape[0] - ch) * b_total_np.shape[0],
+                                   madhyper_pairs = rows.shape[0], tshell_pairs = n_corr)
+    if percent_complete is not None:
+      print(f'Progress: {j + 1} of {len(chunk_plates)} chunks ({percent_complete}%)')
+  print("end time for MAD-HYPE + T-Shell (batch):", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+  if write_files:
+    ### plate names of the "plate" column of the streamed files
+    pd.DataFrame({'plate': range(len(names)), 'name': names}).to_csv(os.path.join(folder_out, prefix + '_plates.tsv'), sep = '\t', index = False)
+  with stats.stage("assemble"):
+    mdh_df = finish_results(results_mdh, writer_mdh, mdh_dtypes.keys(), return_data = return_data)
+    corr_df = finish_results(results_corr, writer_corr, corr_dtypes.keys(), return_data = return_data)
+  if mdh_df is None or corr_df is None:
+    return({"mdh": None, "corr": None, "stats": stats.close()})
+  for df in [mdh_df, corr_df]:
+    df['plate'] = np.array(names, dtype = object)[df['plate'].to_numpy().astype(np.int64)] if df.shape[0] > 0 else pd.Series([], dtype = object)
+  if write_files and output_format == "csv":
+    with stats.stage("write"):
+      mdh_df.to_csv(os.path.join(folder_out, prefix+'_madhyperesults.csv'), index=False)
+      corr_df.to_csv(os.path.join(folder_out, prefix+'_corresults.csv'), index=False)
+  print(f"Number of pairs: {mdh_df.shape[0]}")
+  return({"mdh": mdh_df, "corr": corr_df, "stats": stats.close()})
+
+
+### MAD-HYPE pair scoring ------------------------------------------------------------------------------------------
+### Vectorized port of estimate_pair_prob (R/utils_pairing.R): log10 of prior * P(wells | pair) / P(wells | no pair)
+### for arrays of (wi, wj, wij), where wi/wj are the wells with only the alpha/beta chain and wij the wells with both.
+### The clone frequencies (find_freq) are roots of derivative_prob_function, found by vectorized bisection, and the
+### likelihoods are multinomial log-probabilities (gammaln), so nothing underflows for deep plates.
+
+### derivative of the log-likelihood of a clone frequency f, for w of w_tot wells with c cells per well and prior a
+def freq_derivative(f, w, w_tot, c, a):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        q = (1 - f) ** c
+        q_min = q if c >= 0.001 else (1 - f) ** 0.001
+        inner = -(a * (1 - f)) + f * (c * ((w_tot - w) + w * q / (q_min - 1)))
+    return(np.where(f == 0, -a - w, np.where(f == 1, c * (w_tot - w), inner)))
+
+### clone frequencies for arrays of w (wells with the clone) and w_tot (wells), as find_freq in R (uniroot on [0, 1])
+def find_freq(w, w_tot, cpw = 1000, a = 1, n_iter = 50):
+    w, w_tot = np.broadcast_arrays(np.asarray(w, dtype = np.float64), np.asarray(w_tot, dtype = np.float64))
+    lo = np.zeros(w.shape)
+    hi = np.ones(w.shape)
+    for _ in range(n_iter):
+        mid = (lo + hi) / 2
+        below = freq_derivative(mid, w, w_tot, cpw, a) < 0
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+    ### uniroot returns the upper end when the derivative is 0 there
+    return(np.where(freq_derivative(np.ones(w.shape), w, w_tot, cpw, a) == 0, 1.0, (lo + hi) / 2))
+
+### find_freq(w, w_tot) for all integers 0 <= w <= w_tot <= n_wells, memoized per (n_wells, cpw, alpha):
+### table[w, w_tot] (nan for w > w_tot)
+@functools.lru_cache(maxsize = None)
+def madhyper_freq_table(n_wells, cpw, alpha):
+    w, w_tot = np.triu_indices(n_wells + 1)
+    table = np.full((n_wells + 1, n_wells + 1), np.nan)
+    table[w, w_tot] = find_freq(w, w_tot, cpw, alpha)
+    table.setflags(write = False)
+    return(table)
+
+### multinomial log-probability of the well counts (wi, wj, wij, wo) given the clone frequencies (f_i, f_j, f_ij)
+def madhyper_loglik(wi, wj, wij, wo, f_i, f_j, f_ij, cpw):
+    fs_i, fs_j, fs_ij = [1 - (1 - f) ** cpw for f in [f_i, f_j, f_ij]]
+    p_o = (1 - fs_i) * (1 - fs_j) * (1 - fs_ij)
+    p_i = fs_i * (1 - fs_j) * (1 - fs_ij)
+    p_j = fs_j * (1 - fs_i) * (1 - fs_ij)
+    p_ij = 1 - p_o - p_i - p_j
+    loglik = scipy.special.gammaln(wi + wj + wij + wo + 1)
+    for x, p in [(wi, p_i), (wj, p_j), (wij, p_ij), (wo, p_o)]:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            loglik = loglik - scipy.special.gammaln(x + 1) + np.where(x > 0, x * np.log(np.where(p > 0, p, 0)), 0)
+    return(loglik)
+
+### log10 pair probability (the "score" of run_pairing) for arrays of wi, wj, wij
+def madhyper_score(wi, wj, wij, n_wells, cpw = 1000, alpha = 2, prior = 1):
+    wi, wj, wij = np.broadcast_arrays(*[np.asarray(x, dtype = np.int64) for x in [wi, wj, wij]])
+    n_wells = int(n_wells)
+    wo = n_wells - (wi + wj + wij)
+    if np.any(wi < 0) or np.any(wj < 0) or np.any(wij < 0) or np.any(wo < 0):
+        raise ValueError(f"wi, wj and wij have to be non-negative and add up to at most n_wells ({n_wells})")
+    table = madhyper_freq_table(n_wells, float(cpw), float(alpha))
+    ### pair: clone frequencies of the single-chain wells and of the wells explained by the pair
+    f_i = table[wi, wi + wo]
+    f_j = table[wj, wj + wo]
+    wij_clonal = np.maximum(wij - n_wells * (1 - (1 - f_i) ** cpw) * (1 - (1 - f_j) ** cpw), 0)
+    f_ij = find_freq(wij_clonal, n_wells - wij + wij_clonal, cpw, alpha)
+    match = madhyper_loglik(wi, wj, wij, wo, f_i, f_j, f_ij, cpw)
+    ### no pair: independent alpha and beta clones
+    nonmatch = madhyper_loglik(wi, wj, wij, wo, table[wi + wij, n_wells], table[wj + wij, n_wells], np.zeros(wi.shape), cpw)
+    return(np.log10(prior) + (match - nonmatch) / np.log(10))
+
+### MAD-HYPE look-up surface (mdh), as madhyper_surface in R: mdh[wij, wi] is the smallest wj at which the score of
+### (wi, wj, wij) drops to the threshold along the same search path as the R version. The search over wi for each wij
+### starts where the previous wij stopped, so it runs row by row on a precomputed (wij x wi) grid of wj = 0 scores;
+### the search over wj then advances all rows (wij) at once, one score evaluation per row and step.
+def madhyper_surface(n_wells, cpw = 1000, alpha = 2, prior = 1, threshold = 0.1):
+    n_wells = int(n_wells)
+    mdh = np.zeros((n_wells + 1, n_wells + 1), dtype = np.int32)
+    wij_grid, wi_grid = np.meshgrid(np.arange(n_wells + 1), np.arange(n_wells + 1), indexing = 'ij')
+    valid = wi_grid + wij_grid <= n_wells
+    score0 = np.full(valid.shape, -np.inf)
+    score0[valid] = madhyper_score(wi_grid[valid], 0, wij_grid[valid], n_wells, cpw, alpha, prior)
+    start = np.zeros(n_wells + 1, dtype = np.int64) ### first wi of the wj search (i - 1 in R) for each wij
+    i = 1
+    for wij in range(n_wells, -1, -1):
+        s = np.append(score0[wij], -np.inf)
+        if s[i - 1] > threshold:
+            while s[i - 1] > threshold:
+                i += 1
+        else:
+            while i > 1 and s[i - 1] < threshold:
+                i -= 1
+        start[wij] = i - 1
+    ### walk wi from start down to 0 for all wij at once, increasing wj while the score is above the threshold
+    wij = np.arange(n_wells + 1)
+    wi = start.copy()
+    wj = np.zeros(n_wells + 1, dtype = np.int64)
+    active = np.ones(n_wells + 1, dtype = bool)
+    while np.any(active):
+        idx = np.nonzero(active)[0]
+        ok = wi[idx] + wj[idx] + wij[idx] <= n_wells
+        score = np.full(idx.shape[0], -np.inf)
+        score[ok] = madhyper_score(wi[idx][ok], wj[idx][ok], wij[idx][ok], n_wells, cpw, alpha, prior)
+        up = score > threshold
+        wj[idx[up]] += 1
+        done = idx[~up]
+        mdh[done, wi[done]] = wj[done]
+        wi[done] -= 1
+        active[done[wi[done] < 0]] = False
+    return(mdh)
+
+### approximate bytes of temporaries per (alpha, beta) element in correlation_chunk:
+### correlations and overlaps (float32) plus argpartition indices (int64), and the loss fractions/masks if filtering
+def correlation_tile_cols(max_bytes, chunk_size, n_beta, filter_before_top3 = False, top_k = 3):
+    if max_bytes is None:
+        return(n_beta)
+    bytes_per_element = 32 if filter_before_top3 else 16
+    tile_cols = int(max_bytes // (bytes_per_element * max(int(chunk_size), 1)))
+    return(min(max(tile_cols, int(top_k)), max(n_beta, 1)))
 
-def correlation_process(prefix, folder_out, bigmas, bigmbs, min_wells=2, filter_before_top3=False, write_files = False, chunk_size = 500):
+### T-SHELL top-k correlations for one chunk of alpha chains (a_rows).
+### Beta columns are processed in tiles of tile_cols and the per-tile top-k are merged,
+### so temporaries are (chunk x tile_cols) instead of (chunk x n_beta).
+### Returns row/column indices in the layout of topk_indices, r and wij for each pair, and a_total for the chunk.
+### If the (chunk x n_beta) shared-well counts were already computed (fused mode), pass them as overlaps.
+def correlation_chunk(a_rows, bigmb_w1_scaled, b_occ_t, b_total, filter_before_top3 = False, top_k = 3, tile_cols = None, overlaps = None):
+    with utils.stage_timer("encode"):
+        bigma_w1_scaled = a_rows - mx.mean(a_rows, axis=1, keepdims=True) # mask for madhype
+        bigma_w1_scaled = bigma_w1_scaled / mx.linalg.norm(bigma_w1_scaled,ord=2,axis=1, keepdims=True) # mask for madhype
+        a_total = mx.sum(a_rows > 0, axis=1,keepdims=True)
+        a_occ = (a_rows > 0).astype(mx.float32) if overlaps is None else None
+    overlaps_all = overlaps
+    n_beta = bigmb_w1_scaled.shape[1]
+    if tile_cols is None:
+        tile_cols = n_beta
+    best = None
+    for c0 in range(0, n_beta, tile_cols):
+        c1 = min(c0 + tile_cols, n_beta)
+        with utils.stage_timer("matmul"):
+            pairwise_cors_method2 = mx.matmul(bigma_w1_scaled, bigmb_w1_scaled[:, c0:c1]) #mask for madhype
+            if overlaps_all is None:
+                overlaps = mx.matmul(a_occ, b_occ_t[:, c0:c1]) #optimized
+            else:
+                overlaps = overlaps_all[:, c0:c1]
+        if filter_before_top3:
+            with utils.stage_timer("threshold"):
+                ### remove correlations for pairs with low overlap or high loss fraction
+                overlap_mask = overlaps <= 2 # require overlap of >=3 wells
+                ## calculate loss fraction
+                wij = overlaps 
+                wa = a_total
+                wb = b_total[c0:c1].T
+                loss_a_frac =(wb-wij)/(wij+(wb-wij)+(wa-wij))
+                loss_b_frac =(wa-wij)/(wij+(wb-wij)+(wa-wij))
+                loss_frac_sum = loss_a_frac+loss_b_frac
+                loss_frac_mask = loss_frac_sum >= 0.5 # require (loss_a_frac+loss_b_frac)<0.5
+                combined_mask = mx.logical_or(overlap_mask, loss_frac_mask)
+                pairwise_cors_method2 = mx.where(combined_mask, -1, pairwise_cors_method2) # set correlation to -1 if not enough overlap or loss fraction is too high
+        with utils.stage_timer("topk"):
+            pairs = topk_indices(pairwise_cors_method2, k = top_k)
+            cols = pairs[:, 1].reshape(a_rows.shape[0], -1)
+            tile = (mx.take_along_axis(pairwise_cors_method2, cols, axis=1), cols + c0, mx.take_along_axis(overlaps, cols, axis=1))
+            if best is None:
+                best = tile
+            else: ### merge with the top-k of previous tiles
+                merged = [mx.concatenate([x, y], axis=1) for x, y in zip(best, tile)]
+                keep = mx.argsort(merged[0], axis=1)[:, -top_k:]
+                best = tuple(mx.take_along_axis(x, keep, axis=1) for x in merged)
+    r, cols, wij = best
+    rows = mx.repeat(mx.arange(a_rows.shape[0]), r.shape[1])
+    return(rows, cols.flatten(), r.flatten(), wij.flatten(), a_total)
+
+### T-SHELL pairs for one task: (a_rows, filter_before_top3, top_k, tile_cols), see correlation_process.
+### Returns numpy arrays of row (within chunk), beta column, r, wij and wa for every pair.
+def correlation_task(task, shared):
+    a_rows, filter_before_top3, top_k, tile_cols = task
+    rows, cols, r, wij, a_total = correlation_chunk(mx.array(a_rows), shared['bigmb_w1_scaled'], shared['b_occ_t'], shared['b_total'],
+                                                    filter_before_top3 = filter_before_top3, top_k = top_k, tile_cols = tile_cols)
+    with utils.stage_timer("transfer"):
+        return(to_numpy(rows), to_numpy(cols), to_numpy(r), to_numpy(wij), to_numpy(a_total[:,0][rows]))
+
+def correlation_process(prefix, folder_out, bigmas, bigmbs, min_wells=2, filter_before_top3=False, write_files = False, chunk_size = 500, top_k = 3, max_bytes = None, n_workers = 1, output_format = "csv", return_data = True, stats = None):
     #print("start load:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     #bigmas = mx.array(np.loadtxt(os.path.join(folder_out,prefix+'_bigmas.tsv'), delimiter='\t', dtype=np.float32))
     #bigmbs = mx.array(np.loadtxt(os.path.join(folder_out, prefix+'_bigmbs.tsv'), delimiter='\t', dtype=np.float32))
     #mdh = mx.array(np.loadtxt(prefix+'_mdh.tsv', delimiter='\t', dtype=np.int32))
-    rowinds_bigmas=mx.arange(bigmas.shape[0])
-    rowinds_bigmbs=mx.arange(bigmbs.shape[0])
-    
+    if stats is None:
+        stats = utils.PipelineStats("tshell", backend = mx)
+    stats.set_phase("tshell")
     #now we need to downsize to min_wells
-    non_zero_counts_bigmas = mx.sum(bigmas > 0, axis=1)
-    non_zero_counts_bigmbs = mx.sum(bigmbs > 0, axis=1)
+    with stats.stage("encode"):
+        non_zero_counts_bigmas = well_counts(bigmas)
+        non_zero_counts_bigmbs = well_counts(bigmbs)
     # Find the rows that have more than min_wells non-zero elements
-    # valid_rows_bigmas = mx.nonzero(non_zero_counts_bigmas > min_wells)[0]
-    # valid_rows_bigmbs = mx.nonzero(non_zero_counts_bigmbs > min_wells)[0]
-    valid_rows_bigmas = [i for i, m in enumerate((non_zero_counts_bigmas > min_wells).tolist()) if m]
-    valid_rows_bigmbs = [i for i, m in enumerate((non_zero_counts_bigmbs > min_wells).tolist()) if m]
-    # # Filter the bigmas and bigmbs arrays
-    bigmas = bigmas[valid_rows_bigmas]
-    bigmbs = bigmbs[valid_rows_bigmbs]
+    valid_rows_bigmas = np.nonzero(non_zero_counts_bigmas > min_wells)[0]
+    valid_rows_bigmbs = np.nonzero(non_zero_counts_bigmbs > min_wells)[0]
+    # # Filter bigmbs (the beta side is needed in full); alpha chains are filtered chunk by chunk
+    with stats.stage("load"):
+        bigmbs = dense_rows(bigmbs, valid_rows_bigmbs)
     # # Also retain the corresponding indices
-    rowinds_bigmas = rowinds_bigmas[valid_rows_bigmas]
-    rowinds_bigmbs = rowinds_bigmbs[valid_rows_bigmbs]
+    rowinds_bigmas = valid_rows_bigmas
+    rowinds_bigmbs = valid_rows_bigmbs
+    n_alpha = valid_rows_bigmas.shape[0]
     
     results = []
     chunk_size = int(chunk_size)
     n_wells = bigmas.shape[1]  # Assuming n_wells is the number of columns in bigmas
-    print('total number of chunks', bigmas.shape[0]//chunk_size)
-    total_chunks = (bigmas.shape[0] // chunk_size)+1
-    bigmb_w1_scaled = bigmbs - mx.mean(bigmbs, axis=1, keepdims=True)
-    bigmb_w1_scaled = (bigmb_w1_scaled / mx.linalg.norm(bigmb_w1_scaled,ord=2,axis=1, keepdims=True)).T
-    b_total = mx.sum(bigmbs > 0, axis=1,keepdims=True)
-    bigmbs=(bigmbs > 0).T.astype(mx.float32)
+    n_chunks = -(-n_alpha // chunk_size)
+    print('total number of chunks', n_chunks)
+    with stats.stage("encode"):
+        bigmb_w1_scaled = bigmbs - mx.mean(bigmbs, axis=1, keepdims=True)
+        bigmb_w1_scaled = (bigmb_w1_scaled / mx.linalg.norm(bigmb_w1_scaled,ord=2,axis=1, keepdims=True)).T
+        b_total = mx.sum(bigmbs > 0, axis=1,keepdims=True)
+        bigmbs=(bigmbs > 0).T.astype(mx.float32)
+    tile_cols = correlation_tile_cols(max_bytes, chunk_size, bigmbs.shape[1], filter_before_top3 = filter_before_top3, top_k = top_k)
+    if tile_cols < bigmbs.shape[1]:
+        print(f'Processing beta chains in tiles of {tile_cols} columns (max_bytes = {max_bytes})')
+    shared = {'bigmb_w1_scaled': bigmb_w1_scaled, 'b_occ_t': bigmbs, 'b_total': b_total}
+    b_total_np = to_numpy(b_total[:,0])
+    rowinds_bigmas_np = to_numpy(rowinds_bigmas)
+    rowinds_bigmbs_np = to_numpy(rowinds_bigmbs)
+    def tasks():
+        for ch in range(0, n_alpha, chunk_size):
+            with stats.stage("load"):
+                a_rows = dense_rows(bigmas, valid_rows_bigmas[ch:ch + chunk_size])
+            yield (a_rows, filter_before_top3, top_k, tile_cols)
+    writer = open_result_writer(folder_out, prefix, '_corresults', TSHELL_DTYPES, write_files, output_format)
     print("start processing time for T-Shell:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    for ch in range(0, bigmas.shape[0], chunk_size):
+    for i, (rows, cols, r, wij, wa) in enumerate(run_chunks(correlation_task, tasks(), shared, n_workers = n_workers, stats = stats)):
         #print('Processing chunk', ch)
-        percent_complete = int((ch // chunk_size + 1) / total_chunks * 100)
-        # Print progress only on 5%, 10%, etc.
-        if percent_complete % 10 == 0 and percent_complete > 0:
-            print(f'Progress: {ch} ({percent_complete}%)')
-        chunk_end = min(ch + chunk_size, bigmas.shape[0])
-        row_range = slice(ch, chunk_end)
-        bigma_w1_scaled = bigmas[row_range] - mx.mean(bigmas[row_range], axis=1, keepdims=True) # mask for madhype
-        bigma_w1_scaled = bigma_w1_scaled / mx.linalg.norm(bigma_w1_scaled,ord=2,axis=1, keepdims=True) # mask for madhype
-        a_total = mx.sum(bigmas[row_range] > 0, axis=1,keepdims=True)
-        pairwise_cors_method2 = mx.matmul(bigma_w1_scaled, bigmb_w1_scaled) #mask for madhype
-        overlaps = mx.matmul((bigmas[row_range] > 0).astype(mx.float32), bigmbs) #optimized
-        
-        if filter_before_top3:
-            ### remove correlations for pairs with low overlap or high loss fraction
-            overlap_mask = overlaps <= 2 # require overlap of >=3 wells
-            ## calculate loss fraction
-            wij = overlaps 
-            wa = a_total
-            wb = b_total.T
-            loss_a_frac =(wb-wij)/(wij+(wb-wij)+(wa-wij))
-            loss_b_frac =(wa-wij)/(wij+(wb-wij)+(wa-wij))
-            loss_frac_sum = loss_a_frac+loss_b_frac
-            loss_frac_mask = loss_frac_sum >= 0.5 # require (loss_a_frac+loss_b_frac)<0.5
-            combined_mask = mx.logical_or(overlap_mask, loss_frac_mask)
-            pairwise_cors_method2 = mx.where(combined_mask, -1, pairwise_cors_method2) # set correlation to -1 if not enough overlap or loss fraction is too high
-        pairs = top3_indices(pairwise_cors_method2)
-        result = {
-            'alpha_nuc': 1 + to_numpy(rowinds_bigmas[row_range][pairs[:, 0]]),
-            'beta_nuc': 1 + to_numpy(rowinds_bigmbs[pairs[:, 1]]),
-            'r': to_numpy(pairwise_cors_method2[pairs[:, 0], pairs[:, 1]]),
-            'wij': to_numpy(overlaps[pairs[:, 0], pairs[:, 1]]),
-            'wa': to_numpy(a_total[:,0][pairs[:, 0]]),
-            'wb': to_numpy(b_total[:,0][pairs[:, 1]])
-        }
-        results.append(result)
+        ch = i * chunk_size
+        with stats.stage("assemble"):
+            result = {
+                'alpha_nuc': 1 + rowinds_bigmas_np[ch + rows],
+                'beta_nuc': 1 + rowinds_bigmbs_np[cols],
+                'r': r,
+                'wij': wij,
+                'wa': wa,
+                'wb': b_total_np[cols]
+            }
+        if writer is not None:
+            with stats.stage("write"):
+                writer.write(result)
+        if return_data or writer is None:
+            results.append(result)
+        percent_complete = stats.chunk(i, n_chunks, pairs_evaluated = min(chunk_size, n_alpha - ch) * bigmbs.shape[1], tshell_pairs = rows.shape[0])
+        # Print progress only on 10%, 20%, etc.
+        if percent_complete is not None:
+            print(f'Progress: {min(ch + chunk_size, n_alpha)} ({percent_complete}%)')
         # result_df = pd.DataFrame(result)
         # print('number of rows in this chunk: ' + str(result_df.shape[0]))
         # tmp_df = pd.concat([pd.DataFrame(result) for result in results])
@@ -190,9 +935,209 @@ def correlation_process(prefix, folder_out, bigmas, bigmbs, min_wells=2, filter_
     print("end time for T-Shell:", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 #make pandas dataframe from each element of results and concatenate them
-    results_df = pd.concat([pd.DataFrame(result) for result in results])
-    results_df = results_df.reset_index(drop=True) 
-    if write_files:
-      results_df.to_csv(os.path.join(folder_out, prefix+'_corresults.csv'), index=False)
-    return(results_df)
+    with stats.stage("assemble"):
+        results_df = finish_results(results, writer, TSHELL_DTYPES.keys(), return_data = return_data)
+    if write_files and output_format == "csv":
+      with stats.stage("write"):
+        results_df.to_csv(os.path.join(folder_out, prefix+'_corresults.csv'), index=False)
+    return(results_df if return_data else None)
+
+
+
+### Fused MAD-HYPE + T-SHELL -----------------------------------------------------------------------------
+### Both algorithms need the number of wells shared by every (alpha, beta) pair. In fused mode this
+### (chunk x n_beta) matmul is computed once per alpha chunk and used for the MAD-HYPE mask and for the
+### T-SHELL filtering/output, instead of once in madhyper_process and again in correlation_process.
+### Output is the same as the two separate runs (MAD-HYPE without pruning, on the dense engine).
+### With max_bytes, the overlaps are computed in tiles of beta columns (fused_task_tiled), so that max_bytes bounds
+### the (chunk x tile) temporaries of both algorithms as it does for correlation_process.
+
+### One fused task: (a_rows, corr_rows, filter_before_top3, top_k, tile_cols).
+### corr_rows are the rows of a_rows with more than min_wells wells (None if all of them).
+### tile_cols is the number of beta columns per tile (all beta chains, see correlation_tile_cols).
+def fused_task(task, shared):
+    a_rows, corr_rows, filter_before_top3, top_k, tile_cols = task
+    if tile_cols is not None and tile_cols < shared['b_occ_t'].shape[1]:
+        return(fused_task_tiled(task, shared))
+    a_rows = mx.array(a_rows)
+    a_total = mx.sum(a_rows > 0, axis=1,keepdims=True)
+    with utils.stage_timer("matmul"):
+        overlaps = mx.matmul((a_rows > 0).astype(mx.float32), shared['b_occ_t'])
+    rows, cols, wij = madhyper_pairs_from_overlaps(overlaps, a_total, shared['b_total_mx'], shared['mdh'])
+    with utils.stage_timer("transfer"):
+        madhyper = (rows, cols, wij, to_numpy(a_total[:,0])[rows])
+    if corr_rows is not None:
+        if corr_rows.shape[0] == 0:
+            return(madhyper, None)
+        a_rows = a_rows[mx.array(corr_rows)]
+        overlaps = overlaps[mx.array(corr_rows)]
+    if shared.get('corr_cols') is not None:
+        overlaps = overlaps[:, mx.array(shared['corr_cols'])]
+    rows_c, cols_c, r, wij_c, a_total_c = correlation_chunk(a_rows, shared['bigmb_w1_scaled'], None, shared['b_total_corr'],
+                                                            filter_before_top3 = filter_before_top3, top_k = top_k, overlaps = overlaps)
+    with utils.stage_timer("transfer"):
+        rows_c = to_numpy(rows_c)
+        corr = (rows_c, to_numpy(cols_c), to_numpy(r), to_numpy(wij_c), to_numpy(a_total_c[:,0])[rows_c])
+    return(madhyper, corr)
 
+### fused_task with the beta columns in tiles of tile_cols: each tile's overlaps give its MAD-HYPE pairs and, for the
+### T-SHELL columns (corr_cols) in the tile, a top-k that is merged with the top-k of the previous tiles
+### (as the tiles of correlation_chunk). Same output as fused_task, MAD-HYPE pairs are returned in row-major order.
+def fused_task_tiled(task, shared):
+    a_rows, corr_rows, filter_before_top3, top_k, tile_cols = task
+    a_rows = mx.array(a_rows)
+    a_total = mx.sum(a_rows > 0, axis=1,keepdims=True)
+    a_occ = (a_rows > 0).astype(mx.float32)
+    corr_cols = shared.get('corr_cols')
+    n_beta = shared['b_occ_t'].shape[1]
+    run_corr = corr_rows is None or corr_rows.shape[0] > 0
+    if run_corr and corr_rows is not None:
+        corr_sel = mx.array(corr_rows)
+        a_corr = a_rows[corr_sel]
+    else:
+        a_corr = a_rows
+    mdh_tiles = []
+    best = None
+    a_total_c = None
+    for c0 in range(0, n_beta, tile_cols):
+        c1 = min(c0 + tile_cols, n_beta)
+        with utils.stage_timer("matmul"):
+            overlaps = mx.matmul(a_occ, shared['b_occ_t'][:, c0:c1])
+        rows, cols, wij = madhyper_pairs_from_overlaps(overlaps, a_total, shared['b_total_mx'][c0:c1], shared['mdh'])
+        mdh_tiles.append((rows, cols + c0, wij))
+        if not run_corr:
+            continue
+        k0, k1 = (c0, c1) if corr_cols is None else np.searchsorted(corr_cols, [c0, c1])
+        if k1 == k0:
+            continue
+        if corr_rows is not None:
+            overlaps = overlaps[corr_sel]
+        if corr_cols is not None:
+            overlaps = overlaps[:, mx.array(corr_cols[k0:k1] - c0)]
+        rows_c, cols_c, r, wij_c, a_total_c = correlation_chunk(a_corr, shared['bigmb_w1_scaled'][:, k0:k1], None, shared['b_total_corr'][k0:k1],
+                                                                filter_before_top3 = filter_before_top3, top_k = top_k, overlaps = overlaps)
+        with utils.stage_timer("topk"):
+            tile = tuple(x.reshape(a_corr.shape[0], -1) for x in [r, cols_c + int(k0), wij_c])
+            if best is None:
+                best = tile
+            else: ### merge with the top-k of previous tiles
+                merged = [mx.concatenate([x, y], axis=1) for x, y in zip(best, tile)]
+                keep = mx.argsort(merged[0], axis=1)[:, -top_k:]
+                best = tuple(mx.take_along_axis(x, keep, axis=1) for x in merged)
+    rows = np.concatenate([t[0] for t in mdh_tiles])
+    cols = np.concatenate([t[1] for t in mdh_tiles])
+    wij = np.concatenate([t[2] for t in mdh_tiles])
+    order = np.lexsort((cols, rows))
+    rows, cols, wij = rows[order], cols[order], wij[order]
+    with utils.stage_timer("transfer"):
+        madhyper = (rows, cols, wij, to_numpy(a_total[:,0])[rows])
+    if best is None:
+        return(madhyper, None)
+    r, cols_c, wij_c = best
+    with utils.stage_timer("transfer"):
+        rows_c = np.repeat(np.arange(a_corr.shape[0]), r.shape[1])
+        corr = (rows_c, to_numpy(cols_c).flatten(), to_numpy(r).flatten(), to_numpy(wij_c).flatten(), to_numpy(a_total_c[:,0])[rows_c])
+    return(madhyper, corr)
+
+### beta-side statistics of fused_task for one plate: occupancy, well counts and the mean-centered, normalized
+### well fractions of the beta chains in more than min_wells wells (for T-SHELL)
+def fused_beta_stats(bigmbs, min_wells = 2):
+    b_total_np = well_counts(bigmbs)
+    b_total = mx.array(b_total_np)[:, None]
+    corr_cols = np.nonzero(b_total_np > min_wells)[0]
+    bigmbs_corr = dense_rows(bigmbs, corr_cols)
+    bigmb_w1_scaled = bigmbs_corr - mx.mean(bigmbs_corr, axis=1, keepdims=True)
+    bigmb_w1_scaled = (bigmb_w1_scaled / mx.linalg.norm(bigmb_w1_scaled,ord=2,axis=1, keepdims=True)).T
+    return({
+        'b_occ_t': occupancy_t(bigmbs),
+        'b_total_mx': b_total,
+        'bigmb_w1_scaled': bigmb_w1_scaled,
+        'b_total_corr': b_total if corr_cols.shape[0] == b_total_np.shape[0] else b_total[mx.array(corr_cols)],
+        'corr_cols': None if corr_cols.shape[0] == b_total_np.shape[0] else corr_cols,
+        'b_total_np': b_total_np,
+        'corr_cols_np': corr_cols
+    })
+
+def fused_process(prefix, folder_out, bigmas, bigmbs, mdh, min_wells=2, filter_before_top3=False, write_files = False, chunk_size = 500, top_k = 3, max_bytes = None, n_workers = 1, output_format = "csv", return_data = True, stats = None):
+    if stats is None:
+        stats = utils.PipelineStats("fused", backend = mx)
+    stats.set_phase("fused")
+    chunk_size = int(chunk_size)
+    n_alpha = bigmas.shape[0]
+    n_chunks = -(-n_alpha // chunk_size)
+    print('total number of chunks', n_chunks)
+    ### beta-side statistics, computed once for both algorithms
+    with stats.stage("encode"):
+        beta_stats = fused_beta_stats(bigmbs, min_wells = min_wells)
+        corr_alpha = well_counts(bigmas) > min_wells
+    b_total_np = beta_stats['b_total_np']
+    corr_cols = beta_stats['corr_cols_np']
+    shared = {name: beta_stats[name] for name in ['b_occ_t', 'b_total_mx', 'bigmb_w1_scaled', 'b_total_corr', 'corr_cols']}
+    shared['mdh'] = mdh
+    tile_cols = correlation_tile_cols(max_bytes, chunk_size, b_total_np.shape[0], filter_before_top3 = filter_before_top3, top_k = top_k)
+    if tile_cols < b_total_np.shape[0]:
+        print(f'Processing beta chains in tiles of {tile_cols} columns (max_bytes = {max_bytes})')
+    def tasks():
+        for ch in range(0, n_alpha, chunk_size):
+            chunk_end = min(ch + chunk_size, n_alpha)
+            valid = corr_alpha[ch:chunk_end]
+            corr_rows = None if valid.all() else np.nonzero(valid)[0]
+            with stats.stage("load"):
+                a_rows = dense_rows(bigmas, slice(ch, chunk_end))
+            yield (a_rows, corr_rows, filter_before_top3, top_k, tile_cols)
+    results_mdh = []
+    results_corr = []
+    writer_mdh = open_result_writer(folder_out, prefix, '_madhyperesults', MADHYPE_DTYPES, write_files, output_format)
+    writer_corr = open_result_writer(folder_out, prefix, '_corresults', TSHELL_DTYPES, write_files, output_format)
+    print("start time for MAD-HYPE + T-Shell (fused):", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    for i, (madhyper, corr) in enumerate(run_chunks(fused_task, tasks(), shared, n_workers = n_workers, stats = stats)):
+        ch = i * chunk_size
+        rows, cols, wij, wa = madhyper
+        with stats.stage("assemble"):
+            result = {
+                  'alpha_nuc': 1+ch+rows,
+                  'beta_nuc': 1+cols,
+                  'wij': wij,
+                  'wa': wa,
+                  'wb': b_total_np[cols]
+                  }
+        if writer_mdh is not None:
+            with stats.stage("write"):
+                writer_mdh.write(result)
+        if return_data or writer_mdh is None:
+            results_mdh.append(result)
+        n_corr = 0
+        if corr is not None:
+            rows_c, cols_c, r, wij_c, wa_c = corr
+            n_corr = rows_c.shape[0]
+            with stats.stage("assemble"):
+                alpha_c = np.arange(ch, min(ch + chunk_size, n_alpha))[corr_alpha[ch:ch + chunk_size]]
+                result = {
+                    'alpha_nuc': 1 + alpha_c[rows_c],
+                    'beta_nuc': 1 + corr_cols[cols_c],
+                    'r': r,
+                    'wij': wij_c,
+                    'wa': wa_c,
+                    'wb': b_total_np[corr_cols[cols_c]]
+                }
+            if writer_corr is not None:
+                with stats.stage("write"):
+                    writer_corr.write(result)
+            if return_data or writer_corr is None:
+                results_corr.append(result)
+        percent_complete = stats.chunk(i, n_chunks, pairs_evaluated = min(chunk_size, n_alpha - ch) * b_total_np.shape[0],
+                                       madhyper_pairs = rows.shape[0], tshell_pairs = n_corr)
+        if percent_complete is not None:
+            print(f'Progress: {min(ch + chunk_size, n_alpha)} ({percent_complete}%)')
+    print("end time for MAD-HYPE + T-Shell (fused):", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    with stats.stage("assemble"):
+        mdh_df = finish_results(results_mdh, writer_mdh, MADHYPE_DTYPES.keys(), return_data = return_data)
+        corr_df = finish_results(results_corr, writer_corr, TSHELL_DTYPES.keys(), return_data = return_data)
+    if write_files and output_format == "csv":
+      with stats.stage("write"):
+        mdh_df.to_csv(os.path.join(folder_out, prefix+'_madhyperesults.csv'), index=False)
+        corr_df.to_csv(os.path.join(folder_out, prefix+'_corresults.csv'), index=False)
+    print(f"Number of pairs: {mdh_df.shape[0] if mdh_df is not None else writer_mdh.n_rows}")
+    if not return_data:
+      return(None, None)
+    return(mdh_df, corr_df)
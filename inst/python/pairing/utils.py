@@ -1,7 +1,16 @@
 import subprocess
 import platform
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
 #import importlib
 import importlib.util
+import functools
+import numpy as np
+import pandas as pd
 
 def check_nvidia_gpu():
     try:
@@ -59,3 +68,333 @@ def check_cupy_or_mlx():
     else:
         print("Neither 'cupy' or 'mlx' are installed")
         return("numpy")
+
+### Backend selection --------------------------------------------------------------------------------------------
+### The GPU probe (nvidia-smi / system_profiler) is slow, so it only runs the first time "auto" is resolved and the
+### result is cached for the process. load_backend returns the array module ("mx") for a backend argument:
+### "auto" (GPU backend if available, else numpy), "cpu" (or "numpy"), "cupy" or "mlx"; each module is imported once.
+@functools.lru_cache(maxsize = None)
+def detect_backend():
+    gpu = check_gpu()
+    module = check_cupy_or_mlx()
+    if gpu == "nvidia" and module == "cupy":
+        return("cupy")
+    if gpu == "apple" and module == "mlx":
+        return("mlx")
+    return("numpy")
+
+def load_backend(backend = "auto"):
+    if backend is None or backend == "auto":
+        backend = detect_backend()
+    if backend == "cpu":
+        backend = "numpy"
+    if backend not in ["numpy", "cupy", "mlx"]:
+        raise ValueError(f"Unknown backend '{backend}', expected 'auto', 'cpu', 'cupy' or 'mlx'")
+    return(import_backend(backend))
+
+@functools.lru_cache(maxsize = None)
+def import_backend(backend):
+    print(f"Loading {backend}")
+    try:
+        if backend == "cupy":
+            import cupy #cuda python backend, connect to T4 runtime or other with GPU
+            return(cupy)
+        if backend == "mlx":
+            import mlx.core #use this for apple silicon
+            return(mlx.core)
+    except ImportError:
+        raise ImportError(f"backend = '{backend}' requires the '{backend}' python package")
+    return(np)
+
+
+### Streaming table output -----------------------------------------------------------------------------------
+### ChunkWriter writes a table one chunk at a time, so the full result never has to be held in memory.
+### Each chunk (a dict of column name -> numpy array) becomes one Parquet row group or one Arrow IPC record batch,
+### with the compact column dtypes given in "dtypes" (a dict of column name -> numpy dtype).
+### Requires the optional "pyarrow" package.
+class ChunkWriter:
+    def __init__(self, path, dtypes, output_format = "parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(f"output_format = '{output_format}' requires the 'pyarrow' python package")
+        if output_format not in ["parquet", "arrow"]:
+            raise ValueError(f"Unknown output_format '{output_format}', expected 'parquet' or 'arrow'")
+        self.pa = pa
+        self.path = path
+        self.output_format = output_format
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in self.dtypes.items()])
+        if output_format == "parquet":
+            self.sink = None
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        self.n_rows = 0
+
+    def write(self, chunk):
+        columns = [self.pa.array(np.asarray(chunk[name]).astype(dtype, copy = False)) for name, dtype in self.dtypes.items()]
+        batch = self.pa.record_batch(columns, schema = self.schema)
+        self.writer.write_batch(batch)
+        self.n_rows += batch.num_rows
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+### file extension for each output format
+def output_extension(output_format):
+    return({"csv": ".csv", "tsv": ".tsv", "parquet": ".parquet", "arrow": ".arrow"}[output_format])
+
+### read a table written as .csv/.tsv or with ChunkWriter back in chunks (data frames), one per Parquet row group
+### or Arrow record batch (the whole table for .csv/.tsv)
+def read_chunks(path, output_format):
+    if output_format in ["csv", "tsv"]:
+        yield(pd.read_csv(path, sep = "," if output_format == "csv" else "\t"))
+        return
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(f"reading output_format = '{output_format}' requires the 'pyarrow' python package")
+    if output_format == "parquet":
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            yield(parquet_file.read_row_group(i).to_pandas())
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield(reader.get_batch(i).to_pandas())
+
+### concatenate a list of chunk results (dicts of numpy arrays) column by column into one data frame,
+### without building an intermediate data frame per chunk
+def chunks_to_df(results, columns):
+    return(pd.DataFrame({name: np.concatenate([np.asarray(result[name]) for result in results]) if len(results) > 0 else np.zeros(0) for name in columns}))
+
+
+### Pipeline instrumentation ---------------------------------------------------------------------------------
+### PipelineStats collects, for one run of a pipeline (pairing, TCRdist):
+###  - per-stage timers: load, encode, matmul/gather, bound, threshold, topk, transfer (device to host),
+###    assemble (data frames) and write, summed over all chunks
+###  - one record per chunk: its stage times, counts (pairs evaluated, pairs/edges emitted), the resident memory
+###    of the process (current and peak so far) and the memory held by the GPU backend (cupy pool / mlx)
+###  - progress, reported at exact milestones (every progress_step percent of the chunks)
+### Every chunk, progress and the final summary is an event (a dict) that is written as one JSON line to log_file
+### and passed to callback (e.g. an R function, see run_pairing and TCRdist). summary() is returned by the pipelines.
+### Stage times inside chunk functions are taken with stage_timer(), which records into the stats of the calling
+### thread (see collect_stage_times); on GPU backends kernels run asynchronously, so their time shows up in the
+### next stage that waits for them (usually transfer) unless sync_device is set.
+_stage_local = threading.local()
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    times = getattr(_stage_local, 'times', None)
+    if times is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _stage_local.sync is not None:
+            _stage_local.sync()
+        times[stage] = times.get(stage, 0.0) + time.perf_counter() - start
+
+### run fn(*args) with stage_timer() recording into a fresh dict; returns (result, stage times)
+def collect_stage_times(fn, *args, sync = None):
+    outer = (getattr(_stage_local, 'times', None), getattr(_stage_local, 'sync', None))
+    _stage_local.times = {}
+    _stage_local.sync = sync
+    try:
+        res = fn(*args)
+        return(res, _stage_local.times)
+    finally:
+        _stage_local.times, _stage_local.sync = outer
+
+### function that waits for the queued work of the backend module (None for numpy)
+def device_sync(module):
+    if module.__name__ == "cupy":
+        return(module.cuda.runtime.deviceSynchronize)
+    if module.__name__ == "mlx.core" and hasattr(module, "synchronize"):
+        return(module.synchronize)
+    return(None)
+
+### memory held by the backend in MB: (current, peak); None where the backend does not report it
+def device_memory_mb(module):
+    try:
+        if module.__name__ == "cupy":
+            pool = module.get_default_memory_pool()
+            return(pool.used_bytes() / 2**20, pool.total_bytes() / 2**20)
+        if module.__name__ == "mlx.core":
+            return(module.get_active_memory() / 2**20, module.get_peak_memory() / 2**20)
+    except AttributeError:
+        pass
+    return(None, None)
+
+### resident memory of this process in MB: (current, peak so far); None where not available
+def host_memory_mb():
+    current = None
+    peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2**20 if sys.platform == "darwin" else peak / 2**10 # bytes on macOS, KB on Linux
+    except ImportError:
+        pass
+    return(current, peak)
+
+### numpy scalars/arrays to plain python values for JSON and R
+def plain_value(x):
+    if isinstance(x, dict):
+        return({str(k): plain_value(v) for k, v in x.items()})
+    if isinstance(x, (list, tuple)):
+        return([plain_value(v) for v in x])
+    if isinstance(x, np.ndarray):
+        return(x.tolist())
+    if isinstance(x, np.generic):
+        return(x.item())
+    return(x)
+
+class PipelineStats:
+    def __init__(self, pipeline, log_file = None, callback = None, progress_step = 10, backend = None, sync_device = False):
+        self.pipeline = pipeline
+        self.callback = callback
+        self.progress_step = int(progress_step) if 1 <= int(progress_step) <= 100 else 10
+        self.backend = np if backend is None else backend
+        self.sync = device_sync(self.backend) if sync_device else None
+        self.stages = {}          # stage -> {'seconds', 'calls'}
+        self.counts = {}          # totals of the chunk counts
+        self.chunks = []          # one record per chunk
+        self.info = {}            # run parameters / results (set_info)
+        self.pending = {}         # stage times since the last chunk record
+        self.phase = None         # current step of the pipeline (e.g. "madhyper", "tshell"), see set_phase
+        self.peak_rss_mb = None
+        self.peak_device_mb = None
+        self.start_time = time.perf_counter()
+        self.log = None
+        if log_file is not None:
+            dirname = os.path.dirname(os.path.abspath(log_file))
+            os.makedirs(dirname, exist_ok = True)
+            self.log = open(log_file, 'a')
+
+    def elapsed(self):
+        return(time.perf_counter() - self.start_time)
+
+    ### time a stage run in this thread (outside of chunk functions)
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync is not None:
+                self.sync()
+            self.add_times({stage: time.perf_counter() - start})
+
+    def add_times(self, times):
+        for stage, seconds in times.items():
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+            self.pending[stage] = self.pending.get(stage, 0.0) + seconds
+
+    ### run chunk_fn(*args) with its stage_timer() stages recorded into these stats
+    def run_chunk(self, chunk_fn, *args):
+        res, times = collect_stage_times(chunk_fn, *args, sync = self.sync)
+        self.add_times(times)
+        return(res)
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def set_info(self, **info):
+        self.info.update(info)
+
+    def add_counts(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + int(value)
+
+    def emit(self, event):
+        event = plain_value(dict(event, pipeline = self.pipeline))
+        if self.log is not None:
+            self.log.write(json.dumps(event) + "\n")
+            self.log.flush()
+        if self.callback is not None:
+            self.callback(event)
+
+    ### record chunk `index` (0-based) of n_chunks with its counts; the stage times since the previous chunk are
+    ### attributed to it. Returns the progress percentage if a milestone was passed (for printing), else None.
+    def chunk(self, index, n_chunks, **counts):
+        self.add_counts(**counts)
+        rss, peak_rss = host_memory_mb()
+        device, peak_device = device_memory_mb(self.backend)
+        for value, attr in [(peak_rss if peak_rss is not None else rss, 'peak_rss_mb'), (peak_device, 'peak_device_mb')]:
+            if value is not None and (getattr(self, attr) is None or value > getattr(self, attr)):
+                setattr(self, attr, value)
+        record = {'phase': self.phase, 'chunk': index, 'n_chunks': n_chunks, 'elapsed_s': self.elapsed(), 'stage_s': self.pending,
+                  'counts': {key: int(value) for key, value in counts.items()},
+                  'rss_mb': rss, 'peak_rss_mb': peak_rss, 'device_mb': device, 'peak_device_mb': peak_device}
+        self.pending = {}
+        self.chunks.append(record)
+        self.emit(dict(record, event = 'chunk'))
+        return(self.progress(index + 1, n_chunks))
+
+    ### exact progress: a milestone every progress_step percent of total (and at the end)
+    def progress(self, done, total):
+        if total <= 0:
+            return(None)
+        step = self.progress_step * total
+        if (done * 100) // step == ((done - 1) * 100) // step and done != total:
+            return(None)
+        percent = 100 if done == total else int((done * 100) // step) * self.progress_step
+        self.emit({'event': 'progress', 'phase': self.phase, 'done': done, 'total': total, 'percent': percent, 'elapsed_s': self.elapsed()})
+        return(percent)
+
+    ### per-chunk records as a data frame (one row per chunk, one column per stage time and count)
+    def chunk_table(self):
+        rows = []
+        for record in self.chunks:
+            row = {'phase': record['phase'], 'chunk': record['chunk'], 'elapsed_s': record['elapsed_s']}
+            row.update({stage + '_s': seconds for stage, seconds in record['stage_s'].items()})
+            row.update(record['counts'])
+            row.update({key: record[key] for key in ['rss_mb', 'peak_rss_mb', 'device_mb', 'peak_device_mb']})
+            rows.append(row)
+        return(pd.DataFrame(rows))
+
+    def summary(self):
+        return({
+            'pipeline': self.pipeline,
+            'backend': self.backend.__name__,
+            'wall_s': self.elapsed(),
+            'stages': {stage: dict(entry) for stage, entry in self.stages.items()},
+            'counts': dict(self.counts),
+            'n_chunks': len(self.chunks),
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_device_mb': self.peak_device_mb,
+            'info': plain_value(self.info),
+            'chunks': self.chunk_table()
+        })
+
+    ### emit the summary (without the chunk table) and close the log file; returns summary()
+    def close(self):
+        res = self.summary()
+        self.emit(dict({key: value for key, value in res.items() if key != 'chunks'}, event = 'summary'))
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        return(res)